@@ -0,0 +1,152 @@
+# encoding: utf-8
+""" Anonymisation of activity stream HTML.
+
+Actor names are replaced with 'Publisher' in a single pass over the
+snippet. Only the '.actor' elements are rewritten; everything else is
+copied through exactly as it was.
+
+The result depends only on the snippet, so anonymised snippets are
+cached by a hash of their content, in memory and optionally in Redis.
+"""
+
+import hashlib
+from html import escape
+from html.parser import HTMLParser
+
+from .caching import cache_key, LRUCache, redis_get, redis_set
+
+ACTOR_CLASS = 'actor'
+ACTOR_NAME = 'Publisher'
+# the img element is removed from actor span so need to move actor span to the left to fill up blank space
+ACTOR_STYLE = 'margin-left:-40px'
+
+CACHE_SIZE = 2000
+REDIS_TTL = 0
+
+_FRAGMENTS = LRUCache(max_size=CACHE_SIZE)
+
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+
+
+def _start_tag(tag, attrs):
+    """ Render a start tag for an actor, with our style applied.
+    """
+    attrs = [(name, value) for name, value in attrs if name != 'style']
+    attrs.append(('style', ACTOR_STYLE))
+    parts = [tag]
+    for name, value in attrs:
+        if value is None:
+            parts.append(name)
+        else:
+            parts.append('{}="{}"'.format(name, escape(value, quote=True)))
+    return '<{}>'.format(' '.join(parts))
+
+
+def _is_actor(attrs):
+    for name, value in attrs:
+        if name == 'class' and value and ACTOR_CLASS in value.split():
+            return True
+    return False
+
+
+class ActorRewriter(HTMLParser):
+    """ Replace the contents of '.actor' elements, splicing the
+    rewritten elements between unmodified slices of the original text.
+    """
+
+    def __init__(self, data):
+        super(ActorRewriter, self).__init__(convert_charrefs=False)
+        self.data = data
+        self.output = []
+        # offset of the first character not yet copied to the output
+        self.copied = 0
+        # elements open within the current actor, starting with the actor
+        self.open_tags = []
+        # HTMLParser reports positions as (line, column), counting
+        # only '\n' as a line break
+        self.line_offsets = [0]
+        for line in data.split('\n'):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def _replace_actor(self, tag, attrs, self_closing):
+        start = self._offset()
+        self.output.append(self.data[self.copied:start])
+        self.output.append(_start_tag(tag, attrs))
+        self.output.append(ACTOR_NAME)
+        self.copied = start + len(self.get_starttag_text())
+        if self_closing or tag in VOID_ELEMENTS:
+            self.output.append('</{}>'.format(tag))
+        else:
+            self.open_tags = [tag]
+
+    def handle_starttag(self, tag, attrs):
+        if self.open_tags:
+            if tag not in VOID_ELEMENTS:
+                self.open_tags.append(tag)
+        elif _is_actor(attrs):
+            self._replace_actor(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.open_tags and _is_actor(attrs):
+            self._replace_actor(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            # not within an actor, or a stray end tag inside one
+            return
+        # an end tag also closes any elements left open inside it
+        while self.open_tags.pop() != tag:
+            pass
+        if not self.open_tags:
+            # skip the original contents, but keep the closing tag
+            self.copied = self._offset()
+
+    def rewrite(self):
+        self.feed(self.data)
+        self.close()
+        if self.open_tags:
+            # the actor was never closed, so it contains everything else
+            self.output.append('</{}>'.format(self.open_tags[0]))
+        else:
+            self.output.append(self.data[self.copied:])
+        return ''.join(self.output)
+
+
+def configure(config):
+    global _FRAGMENTS, REDIS_TTL
+
+    cache_size = int(config.get('ckanext.qgov.activity_cache_size', CACHE_SIZE))
+    _FRAGMENTS = LRUCache(max_size=cache_size) if cache_size > 0 else None
+    REDIS_TTL = int(config.get('ckanext.qgov.activity_cache_redis_ttl', 0))
+
+
+def anonymise_actors(data):
+    """ Replace actor names in an activity snippet with 'Publisher'.
+    """
+    if not data or ACTOR_CLASS not in data:
+        return data
+    if _FRAGMENTS is None and REDIS_TTL <= 0:
+        return ActorRewriter(data).rewrite()
+
+    digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+    if _FRAGMENTS is not None:
+        anonymised = _FRAGMENTS.get(digest)
+        if anonymised is not None:
+            return anonymised
+    anonymised = None
+    if REDIS_TTL > 0:
+        anonymised = redis_get(cache_key('activity', digest))
+    if anonymised is None:
+        anonymised = ActorRewriter(data).rewrite()
+        if REDIS_TTL > 0:
+            redis_set(cache_key('activity', digest), anonymised, REDIS_TTL)
+    if _FRAGMENTS is not None:
+        _FRAGMENTS.set(digest, anonymised)
+    return anonymised
@@ -1,11 +1,19 @@
 # encoding: utf-8
 
+from sqlalchemy import and_, event, or_
+from sqlalchemy.orm import object_session
+
 from ckan import authz, model
 from ckan.logic import auth as logic_auth
-from ckan.plugins.toolkit import _, asbool, auth_allow_anonymous_access
+from ckan.plugins.toolkit import _, asbool, auth_allow_anonymous_access, config
 
+from .caching import LRUCache, MISSING, on_commit, request_cache
 from .helpers import user_has_admin_access
 
+# (user name, permission) -> whether the user has that permission
+# in some active group, shared between requests if enabled
+_GROUP_PERMISSIONS = LRUCache(max_size=10000)
+
 
 def member_create(context, data_dict):
     """
@@ -172,32 +180,68 @@ def _requester_is_admin(context):
     return _has_user_permission_for_some_group(requester, 'admin')
 
 
+def _auth_cache_ttl():
+    return int(config.get('ckanext.qgov.auth_cache_ttl', 0))
+
+
+def _forget_group_permissions():
+    _GROUP_PERMISSIONS.clear()
+    request_cache('group_permissions').clear()
+    request_cache('organisation_capacities').clear()
+
+
+def _clear_group_permissions(mapper, connection, target):
+    """ Forget cached permissions when a membership or group is flushed,
+    and again once it is committed, since other threads can cache
+    the old state until then.
+    """
+    _forget_group_permissions()
+    on_commit(_forget_group_permissions, object_session(target))
+
+
+# any membership or group change may grant or revoke permissions
+for _mapped_class in (model.Member, model.Group):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_mapped_class, _event_name, _clear_group_permissions)
+
+
 def _has_user_permission_for_some_group(user_name, permission):
     """Check if the user has the given permission for any group.
+
+    Results are remembered for the rest of the request, and if
+    'ckanext.qgov.auth_cache_ttl' is set, for that many seconds
+    in this process, or until a membership or group changes.
     """
-    user_id = authz.get_user_id_for_username(user_name, allow_none=True)
-    if not user_id:
+    if not user_name:
         return False
+    key = (user_name, permission)
+    memo = request_cache('group_permissions')
+    if key in memo:
+        return memo[key]
+
+    ttl = _auth_cache_ttl()
+    authorised = _GROUP_PERMISSIONS.get(key, MISSING) if ttl > 0 else MISSING
+    if authorised is MISSING:
+        authorised = _query_user_permission_for_some_group(user_name, permission)
+        if ttl > 0:
+            _GROUP_PERMISSIONS.set(key, authorised, ttl)
+    memo[key] = authorised
+    return authorised
+
+
+def _query_user_permission_for_some_group(user_name, permission):
+    """Check in a single query whether the user holds one of the roles
+    with the given permission in any active group.
+    """
     roles = authz.get_roles_with_permission(permission)
-
     if not roles:
         return False
-    # get any groups the user has with the needed role
-    q = model.Session.query(model.Member) \
+    memberships = model.Session.query(model.Member.id) \
+        .join(model.User, model.User.id == model.Member.table_id) \
+        .join(model.Group, and_(model.Group.id == model.Member.group_id,
+                                model.Group.state == 'active')) \
+        .filter(or_(model.User.name == user_name, model.User.id == user_name)) \
         .filter(model.Member.table_name == 'user') \
         .filter(model.Member.state == 'active') \
-        .filter(model.Member.capacity.in_(roles)) \
-        .filter(model.Member.table_id == user_id)
-    group_ids = []
-    for row in q.all():
-        group_ids.append(row.group_id)
-    # if not in any groups has no permissions
-    if not group_ids:
-        return False
-
-    # see if any of the groups are active
-    q = model.Session.query(model.Group) \
-        .filter(model.Group.state == 'active') \
-        .filter(model.Group.id.in_(group_ids))
-
-    return bool(q.count())
+        .filter(model.Member.capacity.in_(roles))
+    return bool(model.Session.query(memberships.exists()).scalar())
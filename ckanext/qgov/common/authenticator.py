@@ -1,16 +1,22 @@
 # encoding: utf-8
-""" Provides a hook to lock accounts after 10 failed login attempts.
+""" Provides a hook to lock accounts after repeated failed login attempts,
+and to rate limit login attempts from each client.
 """
 
 import logging
+import uuid
+
+from passlib.hash import pbkdf2_sha512
 
-from ckan.lib.redis import connect_to_redis
 from ckan.model import User, Session
 from ckan.plugins.toolkit import check_ckan_version, config
 
+from . import metrics, ratelimit
+from .caching import cache_key, redis_delete, redis_get, redis_set
+
 LOG = logging.getLogger(__name__)
 
-LOGIN_THROTTLE_EXPIRY = 1800
+_DUMMY_PASSWORD_HASH = None
 
 
 if check_ckan_version('2.10'):
@@ -53,48 +59,83 @@ def unlock_account(account_id):
     qgov_user = Session.query(User).filter(User.id == account_id).first()
     if qgov_user:
         login_name = qgov_user.name
-        cache_key = '{}.ckanext.qgov.login_attempts.{}'.format(config['ckan.site_id'], login_name)
-        redis_conn = connect_to_redis()
-        if redis_conn.get(cache_key):
-            LOG.debug("Clearing failed login attempts for %s", login_name)
-            redis_conn.delete(cache_key)
+        if ratelimit.reset('login', account=login_name):
+            LOG.debug("Cleared failed login attempts for %s", login_name)
     else:
         LOG.debug("Account %s not found", account_id)
 
 
+def _unknown_user_key(login_name):
+    return cache_key('unknown_user', login_name)
+
+
+def forget_unknown_user(login_name):
+    """ Clear the flag recording that no account has this name,
+    eg because one has just been created.
+    """
+    if login_name:
+        redis_delete(_unknown_user_key(login_name))
+
+
+def _find_user(login_name):
+    """ Look up an account by name, remembering briefly in Redis
+    if it does not exist, so that repeated attempts against unknown
+    names do not reach the database.
+    """
+    key = _unknown_user_key(login_name)
+    if redis_get(key):
+        return None
+    user = User.by_name(login_name)
+    if user is None:
+        ttl = int(config.get('ckanext.qgov.unknown_user_ttl', 60))
+        if ttl > 0:
+            redis_set(key, 1, ttl)
+    return user
+
+
+def _verify_dummy_password(password):
+    """ Spend the same effort as checking a real password,
+    so that response times do not reveal whether an account exists.
+    """
+    global _DUMMY_PASSWORD_HASH
+    if _DUMMY_PASSWORD_HASH is None:
+        _DUMMY_PASSWORD_HASH = pbkdf2_sha512.hash(uuid.uuid4().hex)
+    pbkdf2_sha512.verify(password, _DUMMY_PASSWORD_HASH)
+
+
 def qgov_authenticate(identity, core_authenticate=core_authenticate):
     """ Mimic most of UsernamePasswordAuthenticator.authenticate
-    but add account lockout after 10 failed attempts.
+    but add account lockout and rate limiting of failed attempts.
     """
-    # don't try to increment account lockout if account doesn't exist
     if 'login' not in identity or 'password' not in identity:
         return None
     login_name = identity.get('login')
-    user = User.by_name(login_name)
+    ip_address = ratelimit.client_ip()
+
+    # reject locked accounts and throttled clients before touching the database
+    if ratelimit.check('login', ip=ip_address, account=login_name):
+        LOG.debug('Login as %r failed - too many attempts', login_name)
+        ratelimit.hit('login', ip=ip_address, account=login_name,
+                      counters=(metrics.LOGIN_ATTEMPTS, metrics.LOGIN_FAILURES))
+        return None
+
+    user = _find_user(login_name)
     if user is None:
+        # don't create lockout entries for accounts that don't exist
         LOG.debug('Login failed - username %r not found', login_name)
+        _verify_dummy_password(identity.get('password'))
+        ratelimit.hit('login', ip=ip_address,
+                      counters=(metrics.LOGIN_ATTEMPTS, metrics.LOGIN_FAILURES),
+                      limit_counter=metrics.LOGIN_LOCKOUTS)
         return None
 
-    cache_key = '{}.ckanext.qgov.login_attempts.{}'.format(config['ckan.site_id'], login_name)
-    redis_conn = connect_to_redis()
-    try:
-        login_attempts = int(redis_conn.get(cache_key) or 0)
-    except ValueError:
-        # shouldn't happen but let's play it safe
-        login_attempts = 0
-
-    LOG.debug('%r has failed to log in %s time(s) previously', login_name, login_attempts)
-    if login_attempts >= 10:
-        LOG.debug('Login as %r failed - account is locked', login_name)
-    else:
-        return_value = core_authenticate(identity)
-        if return_value:
-            if login_attempts > 0:
-                LOG.debug("Clearing failed login attempts for %s", login_name)
-                redis_conn.delete(cache_key)
-            return return_value
-        else:
-            LOG.debug('Login as %r failed - password not valid', login_name)
-
-    redis_conn.set(cache_key, login_attempts + 1, ex=LOGIN_THROTTLE_EXPIRY)
+    return_value = core_authenticate(identity)
+    if return_value:
+        ratelimit.reset('login', account=login_name, counters=(metrics.LOGIN_ATTEMPTS,))
+        return return_value
+
+    LOG.debug('Login as %r failed - password not valid', login_name)
+    ratelimit.hit('login', ip=ip_address, account=login_name,
+                  counters=(metrics.LOGIN_ATTEMPTS, metrics.LOGIN_FAILURES),
+                  limit_counter=metrics.LOGIN_LOCKOUTS)
     return None
@@ -0,0 +1,109 @@
+# encoding: utf-8
+""" Benchmarks for QGOV features, run via 'ckan qgov benchmark'.
+
+Each benchmark produces a JSON-serialisable dict, so that results can be
+stored and compared between releases.
+"""
+
+import datetime
+import json
+import math
+import platform
+import time
+
+import click
+from sqlalchemy import event
+
+from ckan import __version__ as ckan_version
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(ordered, pct):
+    """ Nearest-rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def summarise(timings):
+    """ Summarise a list of durations, in seconds, as milliseconds.
+    """
+    ordered = sorted(timings)
+    summary = {
+        'runs': len(ordered),
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'mean_ms': sum(ordered) * 1000 / len(ordered),
+    }
+    for pct in PERCENTILES:
+        summary['p{}_ms'.format(pct)] = percentile(ordered, pct) * 1000
+    return summary
+
+
+def measure(func, repeat, counter=None):
+    """ Call 'func' repeatedly and summarise how long it took.
+    If a QueryCounter is provided, also report statements per call.
+    """
+    timings = []
+    statements = 0
+    for _ in range(repeat):
+        if counter is not None:
+            counter.reset()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        if counter is not None:
+            statements = max(statements, counter.count)
+    summary = summarise(timings)
+    if counter is not None:
+        summary['queries'] = statements
+    return summary
+
+
+class QueryCounter(object):
+    """ Context manager that counts SQL statements sent to an engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+def result_document(name, parameters, results):
+    """ Wrap benchmark results with details of the environment.
+    """
+    return {
+        'benchmark': name,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'ckan_version': ckan_version,
+        'python_version': platform.python_version(),
+        'parameters': parameters,
+        'results': results,
+    }
+
+
+def write_results(document, output=None):
+    """ Write results as JSON to a file, or standard output.
+    """
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        click.echo(text)
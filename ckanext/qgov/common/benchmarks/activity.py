@@ -0,0 +1,80 @@
+# encoding: utf-8
+""" Benchmark the anonymisation of activity stream items, comparing the
+streaming rewriter with the previous BeautifulSoup implementation,
+and with the content-hash cache in front of the rewriter.
+
+No database access is needed.
+"""
+
+import random
+
+from . import measure
+from ..activity import ActorRewriter, anonymise_actors
+
+ACTIVITY_TEMPLATE = u'''<li class="item {activity_type}">
+  <i class="fa icon fa-{icon}"></i>
+  <p>
+    <span class="actor">
+      <img src="//gravatar.com/avatar/{user_hash}?s=30&amp;d=identicon" class="user-image" width="30" height="30" alt="{user}" />
+      <a href="/user/{user}">{user_title}</a>
+    </span>
+    {action} <span><a href="/dataset/{dataset}">{dataset_title}</a></span>
+    <br />
+    <span class="date" title="{date}">
+      {age} days ago
+    </span>
+  </p>
+</li>'''
+
+ACTIVITY_TYPES = (
+    (u'new-package', u'sitemap', u'created the dataset'),
+    (u'changed-package', u'sitemap', u'updated the dataset'),
+    (u'new-resource', u'file', u'added the resource to the dataset'),
+    (u'changed-resource', u'file', u'updated the resource in the dataset'),
+)
+
+
+def _activities(count, seed=None):
+    rng = random.Random(seed)
+    items = []
+    for index in range(count):
+        activity_type, icon, action = rng.choice(ACTIVITY_TYPES)
+        user = u'publisher-{}'.format(rng.randint(1, 50))
+        items.append(ACTIVITY_TEMPLATE.format(
+            activity_type=activity_type, icon=icon, action=action,
+            user=user, user_hash=u'{:032x}'.format(rng.getrandbits(128)),
+            user_title=u'Department &amp; Agency {}'.format(user),
+            dataset=u'dataset-{}'.format(index),
+            dataset_title=u'Quarterly figures &lt;{}&gt;'.format(index),
+            date=u'October {}, 2024, 10:00 (AEST)'.format(rng.randint(1, 28)),
+            age=rng.randint(1, 365)))
+    return items
+
+
+def beautifulsoup_anonymise_actors(data):
+    """ The previous implementation, for comparison.
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(data, 'html.parser')
+    for actor in soup.select(".actor"):
+        actor.string = 'Publisher'
+        actor['style'] = 'margin-left:-40px'
+    return soup.prettify(formatter="html5")
+
+
+def run(items=100, repeat=20, seed=None):
+    """ Time the anonymisation of a page of activity items.
+    """
+    activities = _activities(items, seed)
+    implementations = {
+        'beautifulsoup': beautifulsoup_anonymise_actors,
+        # the rewriter alone, bypassing the cache
+        'streaming': lambda data: ActorRewriter(data).rewrite(),
+        # after the first run, these are all cache hits
+        'cached': anonymise_actors,
+    }
+    timings = {}
+    for name, anonymise in implementations.items():
+        timings[name] = measure(
+            lambda anonymise=anonymise: [anonymise(activity) for activity in activities], repeat)
+    return {'items': items, 'timings': timings}
@@ -0,0 +1,61 @@
+# encoding: utf-8
+""" Benchmark password validation, comparing the compiled policy with
+the previous approach of searching each raw pattern string in turn.
+
+No database access is needed.
+"""
+
+import random
+import re
+import string
+
+from . import measure
+from ..password_policy import DEFAULT_PATTERNS, PasswordPolicy
+
+ALPHABET = string.ascii_letters + string.digits + string.punctuation
+
+
+def _passwords(count, seed=None):
+    """ A mix of weak and strong passwords of varying length.
+    """
+    rng = random.Random(seed)
+    passwords = []
+    for index in range(count):
+        length = rng.randint(6, 64)
+        alphabet = string.ascii_lowercase if index % 3 == 0 else ALPHABET
+        passwords.append(''.join(rng.choice(alphabet) for _ in range(length)))
+    return passwords
+
+
+def _legacy_validate(passwords, min_length, patterns):
+    for password in passwords:
+        errors = []
+        if len(password) < min_length:
+            errors.append('too short')
+        else:
+            for policy in patterns:
+                if not re.search(policy, password):
+                    errors.append('missing pattern')
+
+
+def _policy_validate(passwords, policy):
+    for password in passwords:
+        policy.validate(password)
+
+
+def run(passwords=1000, repeat=20, seed=None, patterns=DEFAULT_PATTERNS):
+    """ Time the validation of a batch of passwords with each approach.
+    """
+    samples = _passwords(passwords, seed)
+    pattern_list = patterns.split(',')
+    policies = {
+        'patterns': PasswordPolicy(patterns=pattern_list),
+        'patterns_classes_entropy': PasswordPolicy(
+            patterns=pattern_list, min_character_classes=3, min_entropy=50),
+    }
+    timings = {
+        'legacy_re_search': measure(lambda: _legacy_validate(samples, 10, pattern_list), repeat),
+    }
+    for name, policy in policies.items():
+        timings[name] = measure(lambda policy=policy: _policy_validate(samples, policy), repeat)
+    return {'passwords': passwords, 'timings': timings}
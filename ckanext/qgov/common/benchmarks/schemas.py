@@ -0,0 +1,37 @@
+# encoding: utf-8
+""" Benchmark the construction of the patched user and resource schemas,
+comparing the schema registry with the previous approach of patching
+the schema again on every call.
+
+No database access is needed.
+"""
+
+from . import measure
+from .. import intercepts
+
+
+def _legacy(name):
+    """ Reproduce the previous per-call cost: user schemas were
+    re-patched in place, while the resource schema was copied and
+    then patched.
+    """
+    core_schema, patch = intercepts.SCHEMA_PATCHES[name]
+    if name == 'default_resource_schema':
+        return lambda: patch(intercepts._copy_schema(core_schema))
+    legacy_schema = intercepts._copy_schema(core_schema)
+    return lambda: patch(legacy_schema)
+
+
+def run(calls=1000, repeat=20):
+    """ Time 'calls' constructions of each schema with each approach.
+    """
+    intercepts.build_schemas()
+    results = {}
+    for name in sorted(intercepts.SCHEMA_PATCHES):
+        legacy = _legacy(name)
+        registry = getattr(intercepts, name)
+        results[name] = {
+            'legacy': measure(lambda: [legacy() for _ in range(calls)], repeat),
+            'registry': measure(lambda: [registry() for _ in range(calls)], repeat),
+        }
+    return {'calls': calls, 'timings': results}
@@ -0,0 +1,135 @@
+# encoding: utf-8
+""" Benchmark the statistics queries against synthetic catalogues.
+
+CKAN requires PostgreSQL, so the catalogue is written to the configured
+database; use a dedicated benchmarking database. Synthetic records have
+IDs beginning with 'qgov-bench-' and are removed afterwards.
+"""
+
+import datetime
+import itertools
+import random
+
+from sqlalchemy import or_
+
+from ckan import model
+
+from . import measure, QueryCounter
+from .. import tables
+from ..stats import Stats
+
+ID_PREFIX = u'qgov-bench-'
+BATCH_SIZE = 5000
+
+
+def _zipf_weights(count, skew):
+    """ Cumulative weights giving a long-tailed distribution, so that a
+    few organisations/groups hold most of the datasets, like real portals.
+    """
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, count + 1)))
+
+
+def _insert(table_name, rows):
+    table = tables.table(table_name)
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.Session.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def remove_catalogue():
+    """ Delete any synthetic records left by a previous run.
+    """
+    prefix = ID_PREFIX + u'%'
+    resource = tables.table('resource')
+    member = tables.table('member')
+    package = tables.table('package')
+    group = tables.table('group')
+    model.Session.execute(resource.delete().where(resource.c.id.like(prefix)))
+    model.Session.execute(member.delete().where(or_(member.c.id.like(prefix), member.c.group_id.like(prefix))))
+    model.Session.execute(package.delete().where(package.c.id.like(prefix)))
+    model.Session.execute(group.delete().where(group.c.id.like(prefix)))
+    model.Session.commit()
+
+
+def seed_catalogue(packages, organisations=50, groups=20, resources_per_package=3,
+                   groups_per_package=1, private_ratio=0.1, deleted_ratio=0.05,
+                   skew=1.1, seed=None):
+    """ Populate the database with a synthetic catalogue.
+    Returns the ID of the organisation with the most datasets.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+
+    org_ids = [u'{}org-{}'.format(ID_PREFIX, i) for i in range(organisations)]
+    group_ids = [u'{}group-{}'.format(ID_PREFIX, i) for i in range(groups)]
+    _insert('group', [{
+        'id': group_id, 'name': group_id, 'title': u'Benchmark {}'.format(group_id),
+        'type': u'organization' if is_org else u'group', 'is_organization': is_org,
+        'state': u'active', 'approval_status': u'approved', 'created': now,
+    } for group_id, is_org in [(org_id, True) for org_id in org_ids] + [(group_id, False) for group_id in group_ids]])
+
+    org_weights = _zipf_weights(organisations, skew)
+    group_weights = _zipf_weights(groups, skew)
+    package_rows = []
+    resource_rows = []
+    member_rows = []
+    for i in range(packages):
+        package_id = u'{}pkg-{}'.format(ID_PREFIX, i)
+        package_rows.append({
+            'id': package_id, 'name': package_id, 'title': u'Benchmark dataset {}'.format(i),
+            'type': u'dataset', 'owner_org': rng.choices(org_ids, cum_weights=org_weights)[0],
+            'private': rng.random() < private_ratio,
+            'state': u'deleted' if rng.random() < deleted_ratio else u'active',
+            'metadata_created': now, 'metadata_modified': now,
+        })
+        for position in range(resources_per_package):
+            resource_id = u'{}res-{}-{}'.format(ID_PREFIX, i, position)
+            resource_rows.append({
+                'id': resource_id, 'package_id': package_id, 'position': position,
+                'name': u'Resource {}'.format(position), 'url': u'https://example.com/' + resource_id,
+                'format': u'CSV', 'state': u'active', 'created': now, 'last_modified': now,
+            })
+        if group_ids:
+            for group_id in set(rng.choices(group_ids, cum_weights=group_weights, k=groups_per_package)):
+                member_rows.append({
+                    'id': u'{}member-{}-{}'.format(ID_PREFIX, i, group_id[len(ID_PREFIX):]),
+                    'table_id': package_id, 'table_name': u'package', 'group_id': group_id,
+                    'capacity': u'public', 'state': u'active',
+                })
+
+    _insert('package', package_rows)
+    _insert('resource', resource_rows)
+    _insert('member', member_rows)
+    model.Session.commit()
+    return org_ids[0]
+
+
+def _consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def run(sizes, repeat=10, keep=False, **catalogue_options):
+    """ Time each statistics query against catalogues of each size.
+    """
+    results = []
+    with QueryCounter(model.meta.engine) as counter:
+        for size in sizes:
+            remove_catalogue()
+            busiest_org = seed_catalogue(size, **catalogue_options)
+            queries = {
+                'top_organisations': Stats.top_organisations,
+                'top_categories': Stats.top_categories,
+                'resource_count': Stats.resource_count,
+                'resource_org_count': lambda: Stats.resource_org_count(busiest_org),
+                'resource_org_counts': Stats.resource_org_counts,
+                'resource_report': Stats.resource_report,
+                'iter_resource_report': lambda: _consume(Stats.iter_resource_report()),
+            }
+            timings = {}
+            for name, query in queries.items():
+                timings[name] = measure(query, repeat, counter)
+                model.Session.rollback()
+            results.append({'packages': size, 'timings': timings})
+            if not keep:
+                remove_catalogue()
+    return results
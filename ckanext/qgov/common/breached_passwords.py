@@ -0,0 +1,218 @@
+# encoding: utf-8
+""" Offline checks against a list of breached passwords.
+
+The list is a sorted file of fixed-width SHA-1 hash prefixes, as built
+by 'ckan qgov build-breached-passwords' from a Have I Been Pwned style
+dump. It is memory-mapped and binary searched, so a check reads a few
+pages from the page cache and needs no other memory.
+"""
+
+import hashlib
+import heapq
+from logging import getLogger
+import mmap
+import os
+import tempfile
+from threading import Lock
+
+LOG = getLogger(__name__)
+
+MAGIC = b'QGOVBPW1'
+HEADER_SIZE = 16
+DEFAULT_PREFIX_BYTES = 8
+SORT_CHUNK_SIZE = 1000000
+
+
+def password_hash(password):
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+    return hashlib.sha1(password).digest()
+
+
+class BreachedPasswords(object):
+    """ Read-only lookups in a breached password file.
+
+    The file is mapped when first needed, and remapped if it has been
+    replaced by a newer build. Each mapping is published together with
+    its layout as one tuple, and is never closed explicitly, so that
+    searches still using a replaced mapping can finish; it is unmapped
+    once no longer referenced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._signature = None
+        # (mmap or None if empty, number of prefixes, prefix width)
+        self._state = None
+
+    def _load(self, stat):
+        with open(self.path, 'rb') as hash_file:
+            header = hash_file.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+                LOG.error("%s is not a breached password file", self.path)
+                return None
+            prefix_bytes = header[len(MAGIC)]
+            count = (stat.st_size - HEADER_SIZE) // prefix_bytes
+            hash_map = mmap.mmap(hash_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if count else None
+        return hash_map, count, prefix_bytes
+
+    def _open(self):
+        """ Retrieve the current (mmap, count, prefix width),
+        or None if the file is missing or invalid.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if self._signature != signature:
+                self._signature = signature
+                self._state = None
+                self._state = self._load(stat)
+            return self._state
+
+    def __len__(self):
+        state = self._open()
+        return state[1] if state else 0
+
+    def is_breached(self, password):
+        """ Check whether a password appears in the list.
+        """
+        try:
+            state = self._open()
+        except (OSError, ValueError) as e:
+            LOG.error("Failed to read breached password file %s: %s", self.path, e)
+            return False
+        if state is None or state[0] is None:
+            return False
+        hash_map, count, width = state
+        target = password_hash(password)[:width]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER_SIZE + middle * width
+            candidate = hash_map[offset:offset + width]
+            if candidate < target:
+                low = middle + 1
+            elif candidate > target:
+                high = middle
+            else:
+                return True
+        return False
+
+
+def _parse_line(line, prefix_bytes, plaintext):
+    """ Extract the hash prefix from a line of a dump, which contains
+    either a plaintext password, or a hex SHA-1 hash optionally
+    followed by ':<count>'.
+    """
+    if plaintext:
+        password = line.rstrip(b'\r\n')
+        return password_hash(password)[:prefix_bytes] if password else None
+    hex_hash = line.split(b':', 1)[0].strip()
+    if len(hex_hash) != 40:
+        return None
+    try:
+        return bytes.fromhex(hex_hash.decode('ascii'))[:prefix_bytes]
+    except ValueError:
+        return None
+
+
+def _prefixes(lines, prefix_bytes, plaintext):
+    for line in lines:
+        prefix = _parse_line(line, prefix_bytes, plaintext)
+        if prefix is not None:
+            yield prefix
+
+
+def _header(prefix_bytes):
+    return MAGIC + bytes([prefix_bytes]) + b'\0' * (HEADER_SIZE - len(MAGIC) - 1)
+
+
+def _write_chunk(prefixes, directory):
+    """ Sort prefixes into a temporary file.
+    """
+    prefixes.sort()
+    chunk = tempfile.TemporaryFile(dir=directory)
+    chunk.write(b''.join(prefixes))
+    chunk.seek(0)
+    return chunk
+
+
+def _read_chunk(chunk, width):
+    while True:
+        prefix = chunk.read(width)
+        if len(prefix) < width:
+            return
+        yield prefix
+
+
+def _write_distinct(prefixes, output):
+    count = 0
+    previous = None
+    for prefix in prefixes:
+        if prefix != previous:
+            output.write(prefix)
+            count += 1
+        previous = prefix
+    return count
+
+
+def build(lines, path, prefix_bytes=DEFAULT_PREFIX_BYTES, plaintext=False):
+    """ Write the hash prefixes from the lines of a dump to a new
+    breached password file, then atomically replace the file at 'path'.
+
+    Dumps that are already ordered by hash, like those from Have I Been
+    Pwned, are written as they are read; otherwise, the remainder is
+    sorted in chunks on disk and merged.
+    Returns the number of distinct prefixes stored.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    prefixes = _prefixes(lines, prefix_bytes, plaintext)
+    runs = []
+    try:
+        count = 0
+        previous = None
+        out_of_order = None
+        with open(temp_path, 'wb') as output:
+            output.write(_header(prefix_bytes))
+            for prefix in prefixes:
+                if previous is not None and prefix < previous:
+                    out_of_order = prefix
+                    break
+                if prefix != previous:
+                    output.write(prefix)
+                    count += 1
+                previous = prefix
+
+        if out_of_order is not None:
+            # what has been written so far is still a sorted run
+            run_path = temp_path + '.run'
+            os.replace(temp_path, run_path)
+            run = open(run_path, 'rb')
+            os.remove(run_path)
+            run.seek(HEADER_SIZE)
+            runs.append(run)
+            pending = [out_of_order]
+            for prefix in prefixes:
+                pending.append(prefix)
+                if len(pending) >= SORT_CHUNK_SIZE:
+                    runs.append(_write_chunk(pending, directory))
+                    pending = []
+            if pending:
+                runs.append(_write_chunk(pending, directory))
+            with open(temp_path, 'wb') as output:
+                output.write(_header(prefix_bytes))
+                count = _write_distinct(
+                    heapq.merge(*[_read_chunk(run, prefix_bytes) for run in runs]), output)
+        os.replace(temp_path, path)
+    finally:
+        for run in runs:
+            run.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return count
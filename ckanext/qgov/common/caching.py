@@ -0,0 +1,156 @@
+# encoding: utf-8
+""" Small caching utilities shared by the QGOV helpers.
+
+Cached values are held in a process-local LRU, optionally backed by
+Redis so that they can be shared between web workers.
+"""
+
+from collections import OrderedDict
+import json
+from logging import getLogger
+from threading import RLock
+import time
+
+from flask import g, has_request_context
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+from ckan import model
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import config
+
+LOG = getLogger(__name__)
+
+MISSING = object()
+
+_AFTER_COMMIT = 'qgov_after_commit'
+
+
+def cache_key(*parts):
+    """ Construct a site-specific Redis key,
+    eg '<site_id>.ckanext.qgov.stats.top_organisations.10'
+    """
+    return '.'.join(
+        ['{}.ckanext.qgov'.format(config.get('ckan.site_id'))]
+        + [str(part) for part in parts])
+
+
+def request_cache(name):
+    """ Retrieve a dict that lives as long as the current request,
+    for memoising values that are requested repeatedly while rendering.
+    Outside of a request, a new empty dict is returned on each call.
+    """
+    if not has_request_context():
+        return {}
+    caches = g.setdefault('_qgov_request_caches', {})
+    return caches.setdefault(name, {})
+
+
+class LRUCache(object):
+    """ Thread-safe, size-bounded LRU cache with optional expiry.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        """ Retrieve an unexpired value, or 'default' if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store a value, evicting the least recently used entries
+        if the cache is full. A 'ttl' of zero or None means the
+        cache default is used.
+        """
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def redis_get(key, default=None):
+    """ Retrieve a JSON value from Redis.
+    Connection problems are logged and treated as a cache miss.
+    """
+    try:
+        value = connect_to_redis().get(key)
+    except RedisError as e:
+        LOG.warning("Unable to read %s from Redis: %s", key, e)
+        return default
+    if value is None:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        LOG.warning("Discarding unreadable cache entry %s", key)
+        return default
+
+
+def redis_set(key, value, ttl=None):
+    """ Store a JSON-serialisable value in Redis, with optional expiry.
+    """
+    try:
+        connect_to_redis().set(key, json.dumps(value), ex=ttl or None)
+    except RedisError as e:
+        LOG.warning("Unable to write %s to Redis: %s", key, e)
+
+
+def redis_delete(*keys):
+    """ Remove one or more keys from Redis.
+    """
+    if not keys:
+        return
+    try:
+        connect_to_redis().delete(*keys)
+    except RedisError as e:
+        LOG.warning("Unable to delete %s from Redis: %s", keys, e)
+
+
+def on_commit(callback, session=None):
+    """ Run 'callback' once the current transaction commits, eg to
+    invalidate a shared cache only when other processes can see the
+    change; until then, they could simply cache the old data again.
+    Each callback runs at most once per commit.
+    """
+    if session is None:
+        session = model.Session()
+    session.info.setdefault(_AFTER_COMMIT, []).append(callback)
+
+
+def _run_after_commit(session):
+    callbacks = session.info.pop(_AFTER_COMMIT, [])
+    for callback in set(callbacks):
+        try:
+            callback()
+        except Exception as e:
+            LOG.error("Failed to run post-commit callback %s: %s", callback, e)
+
+
+event.listen(model.Session, 'after_commit', _run_after_commit)
@@ -0,0 +1,151 @@
+# encoding: utf-8
+""" Command-line tools for Queensland Government portals.
+"""
+
+import click
+
+
+@click.group()
+def qgov():
+    """ Queensland Government portal management commands.
+    """
+
+
+@qgov.command(u'reconcile-stats')
+def reconcile_stats():
+    """ Recalculate the incremental statistics counters from the database.
+    Intended to be run periodically, eg from cron.
+    """
+    from . import counters
+    total, org_counts = counters.reconcile()
+    click.secho(u'Counted {} resources in {} organisations'.format(
+        total, len(org_counts)), fg=u'green')
+
+
+@qgov.command(u'sync-redirects')
+@click.argument(u'source')
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'Redirect map to write (default: the urlm.redirect_map setting)')
+def sync_redirects(source, output):
+    """ Rebuild the local URL Management redirect map from SOURCE,
+    which may be an export URL or a local JSON/CSV file.
+    """
+    from ckan.plugins.toolkit import config
+    from . import urlm
+    output = output or config.get(u'urlm.redirect_map')
+    if not output:
+        raise click.UsageError(u'Specify --output or configure urlm.redirect_map')
+    count = urlm.build_redirect_map(urlm.read_redirects(source), output)
+    click.secho(u'Stored {} redirects in {}'.format(count, output), fg=u'green')
+
+
+@qgov.command(u'build-breached-passwords')
+@click.argument(u'source', type=click.File(u'rb'))
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'File to write (default: the password_breached_hashes_file setting)')
+@click.option(u'--plaintext', is_flag=True,
+              help=u'SOURCE lists passwords, rather than SHA-1 hashes')
+@click.option(u'--prefix-bytes', type=click.IntRange(4, 20), default=8, show_default=True,
+              help=u'Bytes of each hash to keep; fewer gives a smaller file but more false positives')
+def build_breached_passwords(source, output, plaintext, prefix_bytes):
+    """ Build the breached password file from SOURCE ('-' for standard
+    input), a text dump with one SHA-1 hash per line, optionally followed
+    by ':<count>' as in the Have I Been Pwned downloads.
+    """
+    from ckan.plugins.toolkit import config
+    from . import breached_passwords
+    output = output or config.get(u'password_breached_hashes_file')
+    if not output:
+        raise click.UsageError(u'Specify --output or configure password_breached_hashes_file')
+    count = breached_passwords.build(source, output, prefix_bytes=prefix_bytes, plaintext=plaintext)
+    click.secho(u'Stored {} password hashes in {}'.format(count, output), fg=u'green')
+
+
+@qgov.group()
+def benchmark():
+    """ Measure the performance of QGOV features.
+    Results are written as JSON for comparison between releases.
+    """
+
+
+@benchmark.command(u'stats')
+@click.option(u'--packages', u'sizes', type=int, multiple=True, default=[1000, 10000],
+              show_default=True, help=u'Catalogue size to test; may be repeated')
+@click.option(u'--organisations', type=int, default=50, show_default=True)
+@click.option(u'--groups', type=int, default=20, show_default=True)
+@click.option(u'--resources-per-package', type=int, default=3, show_default=True)
+@click.option(u'--groups-per-package', type=int, default=1, show_default=True)
+@click.option(u'--skew', type=float, default=1.1, show_default=True,
+              help=u'Zipf exponent for organisation and group membership')
+@click.option(u'--repeat', type=int, default=10, show_default=True)
+@click.option(u'--seed', type=int, default=None, help=u'Random seed for reproducible catalogues')
+@click.option(u'--keep', is_flag=True, help=u'Leave the synthetic catalogue in place afterwards')
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'Write results to this file instead of standard output')
+@click.confirmation_option(prompt=u'This writes synthetic datasets to the configured database. Continue?')
+def benchmark_stats(sizes, repeat, keep, output, **catalogue_options):
+    """ Time the statistics queries against synthetic catalogues.
+    """
+    from . import benchmarks
+    from .benchmarks import stats as stats_benchmark
+    results = stats_benchmark.run(sizes, repeat=repeat, keep=keep, **catalogue_options)
+    benchmarks.write_results(benchmarks.result_document(
+        u'stats', dict(catalogue_options, sizes=list(sizes), repeat=repeat), results), output)
+
+
+@benchmark.command(u'password-policy')
+@click.option(u'--passwords', type=int, default=1000, show_default=True,
+              help=u'Number of synthetic passwords validated per run')
+@click.option(u'--repeat', type=int, default=20, show_default=True)
+@click.option(u'--seed', type=int, default=None, help=u'Random seed for reproducible passwords')
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'Write results to this file instead of standard output')
+def benchmark_password_policy(passwords, repeat, seed, output):
+    """ Time password validation against the previous implementation.
+    """
+    from ckan.plugins.toolkit import config
+    from . import benchmarks
+    from .benchmarks import password_policy as password_benchmark
+    from .password_policy import DEFAULT_PATTERNS
+    patterns = config.get(u'password_patterns', DEFAULT_PATTERNS)
+    results = password_benchmark.run(passwords, repeat=repeat, seed=seed, patterns=patterns)
+    benchmarks.write_results(benchmarks.result_document(
+        u'password-policy', {u'passwords': passwords, u'repeat': repeat, u'seed': seed,
+                             u'patterns': patterns}, results), output)
+
+
+@benchmark.command(u'schemas')
+@click.option(u'--calls', type=int, default=1000, show_default=True,
+              help=u'Schema constructions per run')
+@click.option(u'--repeat', type=int, default=20, show_default=True)
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'Write results to this file instead of standard output')
+def benchmark_schemas(calls, repeat, output):
+    """ Time the construction of the patched user and resource schemas.
+    """
+    from . import benchmarks
+    from .benchmarks import schemas as schema_benchmark
+    results = schema_benchmark.run(calls, repeat=repeat)
+    benchmarks.write_results(benchmarks.result_document(
+        u'schemas', {u'calls': calls, u'repeat': repeat}, results), output)
+
+
+@benchmark.command(u'activity')
+@click.option(u'--items', type=int, default=100, show_default=True,
+              help=u'Activity stream items per page')
+@click.option(u'--repeat', type=int, default=20, show_default=True)
+@click.option(u'--seed', type=int, default=None, help=u'Random seed for reproducible activities')
+@click.option(u'--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help=u'Write results to this file instead of standard output')
+def benchmark_activity(items, repeat, seed, output):
+    """ Time the anonymisation of activity stream pages.
+    """
+    from . import benchmarks
+    from .benchmarks import activity as activity_benchmark
+    results = activity_benchmark.run(items, repeat=repeat, seed=seed)
+    benchmarks.write_results(benchmarks.result_document(
+        u'activity', {u'items': items, u'repeat': repeat, u'seed': seed}, results), output)
+
+
+def get_commands():
+    return [qgov]
@@ -0,0 +1,195 @@
+# encoding: utf-8
+""" Incrementally maintained resource counters for site statistics.
+
+Each public, active dataset's contribution (its organisation and number
+of active resources) is recorded in Redis, and the site and organisation
+totals are adjusted by the difference whenever the dataset or one of its
+resources changes. 'ckan qgov reconcile-stats' rebuilds everything from
+the database, and should be run periodically to catch changes that
+bypass the plugin hooks, such as bulk visibility updates.
+"""
+
+from logging import getLogger
+
+from redis.exceptions import LockError, RedisError
+from sqlalchemy import and_, func, select
+
+from ckan import model
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import asbool, config
+
+from .caching import cache_key
+from .tables import table
+
+LOG = getLogger(__name__)
+
+RECONCILE_BATCH_SIZE = 10000
+RECONCILE_LOCK_TIMEOUT = 300
+
+# KEYS: total, organisation counts, package contributions
+# ARGV: package ID, organisation ID, resource count
+# Does nothing if the counters have not been initialised.
+SYNC_PACKAGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local old_count, old_org = 0, ''
+local previous = redis.call('HGET', KEYS[3], ARGV[1])
+if previous then
+    local separator = string.find(previous, ':', 1, true)
+    old_count = tonumber(string.sub(previous, 1, separator - 1))
+    old_org = string.sub(previous, separator + 1)
+end
+local new_count = tonumber(ARGV[3])
+if old_org ~= '' and old_count ~= 0 then
+    redis.call('HINCRBY', KEYS[2], old_org, -old_count)
+end
+if ARGV[2] ~= '' and new_count ~= 0 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2], new_count)
+end
+if new_count == 0 then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+else
+    redis.call('HSET', KEYS[3], ARGV[1], new_count .. ':' .. ARGV[2])
+end
+return redis.call('INCRBY', KEYS[1], new_count - old_count)
+"""
+
+
+def _keys():
+    return (cache_key('counters', 'resources'),
+            cache_key('counters', 'organisations'),
+            cache_key('counters', 'packages'))
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def enabled():
+    return asbool(config.get('ckanext.qgov.stats.incremental_counters', False))
+
+
+def sync_package(package_id):
+    """ Update the counters to reflect the current state of a dataset.
+    """
+    if not package_id or not enabled():
+        return
+    # some hooks receive the caller's input, which may hold a name
+    package_obj = model.Package.get(package_id)
+    if package_obj is not None:
+        package_id = package_obj.id
+    resource = table('resource')
+    package = table('package')
+    query = select(package.c.owner_org, func.count(resource.c.id)). \
+        select_from(package.outerjoin(resource, and_(resource.c.package_id == package.c.id,
+                                                     resource.c.state == 'active'))). \
+        where(and_(package.c.id == package_id,
+                   package.c.state == 'active',
+                   package.c.private != 'TRUE')). \
+        group_by(package.c.owner_org)
+
+    model.Session.flush()
+    row = model.Session.execute(query).first()
+    owner_org, count = (row[0] or '', row[1]) if row else ('', 0)
+    try:
+        redis_conn = connect_to_redis()
+        redis_conn.register_script(SYNC_PACKAGE_SCRIPT)(
+            keys=_keys(), args=[package_id, owner_org, count], client=redis_conn)
+    except RedisError as e:
+        LOG.warning("Unable to update resource counters for %s: %s", package_id, e)
+
+
+def resource_count():
+    """ Retrieve the number of resources in public datasets,
+    or None if the counters are unavailable.
+    """
+    try:
+        value = connect_to_redis().get(_keys()[0])
+    except RedisError as e:
+        LOG.warning("Unable to read resource counters: %s", e)
+        return None
+    return int(value) if value is not None else None
+
+
+def resource_org_counts():
+    """ Retrieve the number of resources in each organisation,
+    or None if the counters are unavailable.
+    """
+    total_key, org_key = _keys()[:2]
+    try:
+        pipe = connect_to_redis().pipeline()
+        pipe.exists(total_key)
+        pipe.hgetall(org_key)
+        initialised, org_counts = pipe.execute()
+    except RedisError as e:
+        LOG.warning("Unable to read resource counters: %s", e)
+        return None
+    if not initialised:
+        return None
+    return {_text(org_id): int(count) for org_id, count in org_counts.items() if int(count) > 0}
+
+
+def clear():
+    """ Remove the counters, so they will be rebuilt when next needed.
+    """
+    connect_to_redis().delete(*_keys())
+
+
+def reconcile_once():
+    """ Recalculate all counters from the database, unless another
+    worker is already doing so.
+    Returns (None, None) if the counters were not rebuilt.
+    """
+    lock = connect_to_redis().lock(cache_key('counters', 'lock'), timeout=RECONCILE_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        LOG.debug("Resource counters are already being reconciled")
+        return None, None
+    try:
+        return reconcile()
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # the lock expired, and may now belong to someone else
+            pass
+
+
+def reconcile():
+    """ Recalculate all counters from the database.
+    Returns the total number of resources and the per-organisation counts.
+    """
+    resource = table('resource')
+    package = table('package')
+    query = select(package.c.id, package.c.owner_org, func.count(resource.c.id)). \
+        where(and_(resource.c.package_id == package.c.id,
+                   resource.c.state == 'active',
+                   package.c.state == 'active',
+                   package.c.private != 'TRUE')). \
+        group_by(package.c.id, package.c.owner_org)
+
+    total = 0
+    org_counts = {}
+    package_counts = {}
+    for package_id, owner_org, count in model.Session.execute(query):
+        total += count
+        if owner_org:
+            org_counts[owner_org] = org_counts.get(owner_org, 0) + count
+        package_counts[package_id] = '{}:{}'.format(count, owner_org or '')
+
+    total_key, org_key, package_key = _keys()
+    pipe = connect_to_redis().pipeline(transaction=True)
+    pipe.delete(total_key, org_key, package_key)
+    if org_counts:
+        pipe.hset(org_key, mapping=org_counts)
+    package_ids = list(package_counts.keys())
+    for start in range(0, len(package_ids), RECONCILE_BATCH_SIZE):
+        pipe.hset(package_key, mapping={
+            package_id: package_counts[package_id]
+            for package_id in package_ids[start:start + RECONCILE_BATCH_SIZE]})
+    # set the total last, since it marks the counters as usable
+    pipe.set(total_key, total)
+    pipe.execute()
+    LOG.info("Reconciled resource counters: %s resources in %s organisations",
+             total, len(org_counts))
+    return total, org_counts
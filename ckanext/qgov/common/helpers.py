@@ -1,20 +1,22 @@
 # encoding: utf-8
 
 import datetime
-import json
 import logging
 import random
-import requests
-
-from bs4 import BeautifulSoup
 
 from ckan import model
 from ckan.lib import formatters
 from ckan.plugins import toolkit
-from ckan.plugins.toolkit import _, g, h, get_action
+from ckan.plugins.toolkit import _, config, g, h, get_action
+
+from . import json_schema
+from .activity import anonymise_actors
+from .caching import cache_key, on_commit, redis_delete, redis_get, redis_set, request_cache
 
 LOG = logging.getLogger(__name__)
 
+ORGANISATION_FIELDS = ('id', 'name', 'title')
+
 
 def make_uncached_response(response):
     response.headers.set('cache-control', 'no-cache'),
@@ -64,6 +66,60 @@ def organisation_list():
     return toolkit.get_action('organization_list')(data_dict={'all_fields': True})
 
 
+def _organisation_list_ttl():
+    return int(config.get('ckanext.qgov.organisation_list_ttl', 3600))
+
+
+def _query_organisation_summaries():
+    rows = model.Session.query(model.Group.id, model.Group.name, model.Group.title) \
+        .filter(model.Group.is_organization.is_(True), model.Group.state == 'active') \
+        .order_by(model.Group.title, model.Group.name)
+    return [list(row) for row in rows]
+
+
+def _organisation_summaries():
+    """ Retrieve [id, name, title] for every active organisation,
+    shared between workers via Redis until an organisation changes.
+    """
+    cache = request_cache('organisation_summaries')
+    if 'all' not in cache:
+        ttl = _organisation_list_ttl()
+        key = cache_key('organisation_summaries')
+        summaries = redis_get(key) if ttl > 0 else None
+        if summaries is None:
+            summaries = _query_organisation_summaries()
+            if ttl > 0:
+                redis_set(key, summaries, ttl)
+        cache['all'] = summaries
+    return cache['all']
+
+
+def organisation_summary_list(fields=ORGANISATION_FIELDS):
+    """ List active organisations by title, with only the requested
+    fields (any of 'id', 'name' and 'title').
+    Much cheaper than 'organisation_list' when populating a dropdown.
+    """
+    indexes = [(field, ORGANISATION_FIELDS.index(field)) for field in fields]
+    return [{field: row[index] for field, index in indexes}
+            for row in _organisation_summaries()]
+
+
+def _forget_shared_organisations():
+    request_cache('organisation_summaries').clear()
+    redis_delete(cache_key('organisation_summaries'))
+
+
+def forget_organisations():
+    """ Discard cached organisation summaries, eg because
+    an organisation has been modified.
+    The hooks run before the change is committed, so the shared copy
+    is only discarded after the commit; otherwise another worker could
+    store the old rows again in the meantime.
+    """
+    request_cache('organisation_summaries').clear()
+    on_commit(_forget_shared_organisations)
+
+
 def random_tags():
     """ Show the most-used tags in a random order.
     """
@@ -72,6 +128,22 @@ def random_tags():
     return tags
 
 
+def _organisation_capacities(user_id):
+    """ Find the capacities in which a user belongs to any organisation,
+    in a single query, remembering them for the rest of the request.
+    """
+    memo = request_cache('organisation_capacities')
+    if user_id not in memo:
+        query = model.Session.query(model.Member.capacity).distinct() \
+            .join(model.Group, model.Group.id == model.Member.group_id) \
+            .filter(model.Group.type == 'organization') \
+            .filter(model.Member.table_name == 'user') \
+            .filter(model.Member.table_id == user_id) \
+            .filter(model.Member.state == 'active')
+        memo[user_id] = frozenset(capacity for (capacity,) in query)
+    return memo[user_id]
+
+
 def user_has_admin_access(include_editor_access):
     user = toolkit.current_user or toolkit.g.userobj
     # If user is "None" - they are not logged in.
@@ -80,11 +152,8 @@ def user_has_admin_access(include_editor_access):
     if user.sysadmin:
         return True
 
-    groups_admin = user.get_groups('organization', 'admin')
-    groups_editor = user.get_groups('organization', 'editor') if include_editor_access else []
-    groups_list = groups_admin + groups_editor
-    organisation_list = [g for g in groups_list if g.type == 'organization']
-    return len(organisation_list) > 0
+    capacities = _organisation_capacities(user.id)
+    return 'admin' in capacities or (include_editor_access and 'editor' in capacities)
 
 
 def format_activity_data(data):
@@ -96,14 +165,7 @@ def format_activity_data(data):
     if (user_has_admin_access(True)):
         return data
 
-    soup = BeautifulSoup(data, 'html.parser')
-
-    for actor in soup.select(".actor"):
-        actor.string = 'Publisher'
-        # the img element is removed from actor span so need to move actor span to the left to fill up blank space
-        actor['style'] = 'margin-left:-40px'
-
-    return soup.prettify(formatter="html5")
+    return anonymise_actors(data)
 
 
 def activity_type_nice(activity_type):
@@ -117,28 +179,61 @@ def activity_type_nice(activity_type):
     return ' '.join(activity_type)
 
 
+def _show_package(package_id):
+    """ Retrieve a package once per request, along with a map of its
+    resources by ID, so that helpers which need the same dataset share
+    a single package_show.
+    """
+    packages = request_cache('package_show')
+    if package_id not in packages:
+        context = {'ignore_auth': False, 'model': model,
+                   'user': g.user}
+        package = get_action('package_show')(context, {'id': package_id})
+        resources = {resource['id']: resource for resource in package.get('resources', [])}
+        entry = (package, resources)
+        packages[package_id] = entry
+        for alias in (package.get('id'), package.get('name')):
+            if alias:
+                packages.setdefault(alias, entry)
+    return packages[package_id]
+
+
+def forget_packages():
+    """ Discard packages cached during this request, eg because
+    one has been modified.
+    """
+    request_cache('package_show').clear()
+
+
 def get_resource_name(data_dict):
     """ Retrieve the name of a resource given its ID.
     """
-    context = {'ignore_auth': False, 'model': model,
-               'user': g.user}
-    package = get_action('package_show')(context, data_dict)
+    package, resources = _show_package(data_dict['id'])
     if 'error' not in package:
-        resources = package.get('resources', [])
-        for resource in resources:
-            if data_dict['resource_id'] == resource['id']:
-                return resource['name']
-        return None
+        resource = resources.get(data_dict['resource_id'])
+        return resource['name'] if resource else None
     return None
 
 
+def _get_resource(package_id, resource_id):
+    """ Retrieve a resource, preferably from its package's cached
+    package_show.
+    """
+    resource = None
+    if package_id:
+        resource = _show_package(package_id)[1].get(resource_id)
+    if resource is None:
+        context = {'ignore_auth': False, 'model': model,
+                   'user': g.user}
+        resource = get_action('resource_show')(context, {"id": resource_id})
+    return resource
+
+
 def generate_download_url(package_id, resource_id):
     """ Construct a URL to download a resource given its ID.
     """
-    context = {'ignore_auth': False, 'model': model,
-               'user': g.user}
     try:
-        resource = get_action('resource_show')(context, {"id": resource_id})
+        resource = _get_resource(package_id, resource_id)
         if 'error' not in resource:
             return resource.get('url')
     except Exception:
@@ -148,23 +243,17 @@ def generate_download_url(package_id, resource_id):
 def generate_json_schema(package_id, validation_schema):
     """ Retrieve the validation schema for a package, if any.
     """
-    validation_schema_url = generate_download_url(package_id,
-                                                  validation_schema)
-    req = requests.get(validation_schema_url, verify=False)
-    if req.status_code == requests.codes.ok:
-        try:
-            return json.loads(req.text)
-        except Exception:
-            return {"error": "Failed to parse json schema"}
-    else:
-        return {"error": "Failed to retrieve json schema"}
+    try:
+        resource = _get_resource(package_id, validation_schema)
+    except Exception:
+        return dict(json_schema.FETCH_ERROR)
+    return json_schema.get_schema(resource)
 
 
 def get_validation_resources(data_dict):
     """ Return the validation schemas associated with a package.
     """
-    context = {'ignore_auth': False, 'model': model, 'user': g.user}
-    package = get_action('package_show')(context, data_dict)
+    package = _show_package(data_dict['id'])[0]
     if 'error' not in package:
         resources = package.get('resources', [])
         validation_schemas = []
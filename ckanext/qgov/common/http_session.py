@@ -0,0 +1,48 @@
+# encoding: utf-8
+""" Pooled HTTP sessions for contacting other services.
+"""
+
+import os
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def build_session(pool_size=10, retries=1, proxy=None, verify=True):
+    """ Create an HTTP session with a keep-alive connection pool,
+    and the proxy and retry settings applied once.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=0.1,
+                          status_forcelist=(502, 503, 504), raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if proxy:
+        session.proxies = {'http': 'http://' + proxy, 'https': 'https://' + proxy}
+    session.verify = verify
+    return session
+
+
+class ProcessSession(object):
+    """ Holds one session per process, built on first use.
+    Forked workers build their own, since connections can't be shared
+    between processes.
+    """
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._session = None
+        self._pid = None
+        self._lock = Lock()
+
+    def get(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = build_session(**self.settings)
+                    self._pid = os.getpid()
+        return self._session
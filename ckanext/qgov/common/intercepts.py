@@ -3,7 +3,6 @@
 """
 
 from logging import getLogger
-import re
 
 from ckan import authz
 from ckan.lib.navl.dictization_functions import Missing
@@ -12,7 +11,8 @@ from ckan.logic import schema as schemas, validators
 from ckan.plugins.toolkit import _, get_or_bust, get_validator, \
     chained_action, side_effect_free
 
-from .authenticator import unlock_account
+from .authenticator import forget_unknown_user, unlock_account
+from .password_policy import PasswordPolicy
 from .user_creation import helpers as user_creation_helpers
 
 LOG = getLogger(__name__)
@@ -27,14 +27,12 @@ RESOURCE_SCHEMA = schemas.default_resource_schema()
 
 
 def configure(config):
-    global password_min_length
-    global password_patterns
+    global password_policy
 
-    password_min_length = int(config.get('password_min_length', '10'))
-    password_patterns = config.get(
-        'password_patterns',
-        r'.*[0-9].*,.*[a-z].*,.*[A-Z].*,.*[-`~!@#$%^&*()_+=|\\/ ].*'
-    ).split(',')
+    password_policy = PasswordPolicy.from_config(config)
+    _SCHEMAS.clear()
+    # the resource schema needs plugin validators, so build it on first use
+    build_schemas([name for name in SCHEMA_PATCHES if name != 'default_resource_schema'])
 
 
 def set_intercepts():
@@ -65,16 +63,9 @@ def user_password_validator(key, data, errors, context):
         errors[('password',)].append(_('Passwords must be strings'))
     elif value == '':
         pass
-    elif len(value) < password_min_length:
-        errors[('password',)].append(
-            _('Your password must be {min} characters or longer'.format(min=password_min_length))
-        )
     else:
-        for policy in password_patterns:
-            if not re.search(policy, value):
-                errors[('password',)].append(
-                    _('Must contain at least one number, lowercase letter, capital letter, and symbol')
-                )
+        for message, params in password_policy.validate(value):
+            errors[('password',)].append(_(message).format(**params))
 
 
 def _apply_schema_validator(user_schema, field_name, validator_name='user_password_validator',
@@ -96,76 +87,122 @@ def _remove_schema_validator(user_schema, field_name, validator):
     return user_schema
 
 
-def default_user_schema():
-    """ Add our password validator function to the default list.
+def _copy_schema(schema):
+    """ Copy a schema one level deep, so that callers can add or remove
+    validators without affecting the next caller. We can't make an
+    entirely shallow copy, or else it will be permanently modified by
+    eg schema.default_show_package_schema, but we don't want infinite
+    depth either.
     """
-    user_schema = DEFAULT_USER_SCHEMA
-    user_schema = _apply_schema_validator(user_schema, 'password')
+    return {key: value[:] if isinstance(value, list) else value
+            for key, value in schema.items()}
+
+
+def _require_fullname(user_schema):
     _remove_schema_validator(user_schema, 'fullname', ignore_missing)
-    user_schema = _apply_schema_validator(
+    return _apply_schema_validator(
         user_schema, 'fullname',
         validator_name='not_empty', validator=not_empty)
-    return user_schema
+
+
+def _patch_default_user_schema(user_schema):
+    user_schema = _apply_schema_validator(user_schema, 'password')
+    return _require_fullname(user_schema)
+
+
+def _patch_user_new_form_schema(user_schema):
+    user_schema = _apply_schema_validator(user_schema, 'password')
+    user_schema = _apply_schema_validator(user_schema, 'password1')
+    return _require_fullname(user_schema)
+
+
+def _patch_user_perform_reset_form_schema(user_schema):
+    return _apply_schema_validator(user_schema, 'password1')
+
+
+def _patch_user_edit_form_schema(user_schema):
+    user_schema = _apply_schema_validator(user_schema, 'password')
+    user_schema = _apply_schema_validator(user_schema, 'password1')
+    return _require_fullname(user_schema)
+
+
+def _patch_default_update_user_schema(user_schema):
+    user_schema = _apply_schema_validator(user_schema, 'password')
+    user_schema = _require_fullname(user_schema)
+    return user_creation_helpers.add_custom_validator_to_user_schema(user_schema)
+
+
+def _patch_default_resource_schema(resource_schema):
+    resource_schema['url'].append(get_validator('valid_url'))
+    return resource_schema
+
+
+# name: (core schema, function to apply our changes)
+SCHEMA_PATCHES = {
+    'default_user_schema': (DEFAULT_USER_SCHEMA, _patch_default_user_schema),
+    'user_new_form_schema': (USER_NEW_FORM_SCHEMA, _patch_user_new_form_schema),
+    'user_edit_form_schema': (USER_EDIT_FORM_SCHEMA, _patch_user_edit_form_schema),
+    'default_update_user_schema': (DEFAULT_UPDATE_USER_SCHEMA, _patch_default_update_user_schema),
+    'default_resource_schema': (RESOURCE_SCHEMA, _patch_default_resource_schema),
+}
+if hasattr(schemas, 'user_perform_reset_form_schema'):
+    SCHEMA_PATCHES['user_perform_reset_form_schema'] = (
+        USER_PERFORM_RESET_FORM_SCHEMA, _patch_user_perform_reset_form_schema)
+
+_SCHEMAS = {}
+
+
+def build_schemas(names=None):
+    """ Apply our changes to copies of the core schemas, once,
+    so that each request only needs to copy the result.
+    """
+    for name in names or SCHEMA_PATCHES:
+        core_schema, patch = SCHEMA_PATCHES[name]
+        _SCHEMAS[name] = patch(_copy_schema(core_schema))
+
+
+def _get_schema(name):
+    schema = _SCHEMAS.get(name)
+    if schema is None:
+        build_schemas([name])
+        schema = _SCHEMAS[name]
+    return _copy_schema(schema)
+
+
+def default_user_schema():
+    """ Add our password validator function to the default list.
+    """
+    return _get_schema('default_user_schema')
 
 
 def user_new_form_schema():
     """ Apply our password validator function when creating a new user.
     """
-    user_schema = USER_NEW_FORM_SCHEMA
-    user_schema = _apply_schema_validator(user_schema, 'password')
-    user_schema = _apply_schema_validator(user_schema, 'password1')
-    _remove_schema_validator(user_schema, 'fullname', ignore_missing)
-    user_schema = _apply_schema_validator(
-        user_schema, 'fullname',
-        validator_name='not_empty', validator=not_empty)
-    return user_schema
+    return _get_schema('user_new_form_schema')
 
 
 def user_perform_reset_form_schema():
     """ Apply our password validator function when resetting a password.
     """
-    user_schema = USER_PERFORM_RESET_FORM_SCHEMA
-    user_schema = _apply_schema_validator(user_schema, 'password1')
-    return user_schema
+    return _get_schema('user_perform_reset_form_schema')
 
 
 def user_edit_form_schema():
     """ Apply our password validator function when editing an existing user.
     """
-    user_schema = USER_EDIT_FORM_SCHEMA
-    user_schema = _apply_schema_validator(user_schema, 'password')
-    user_schema = _apply_schema_validator(user_schema, 'password1')
-    _remove_schema_validator(user_schema, 'fullname', ignore_missing)
-    user_schema = _apply_schema_validator(
-        user_schema, 'fullname',
-        validator_name='not_empty', validator=not_empty)
-    return user_schema
+    return _get_schema('user_edit_form_schema')
 
 
 def default_update_user_schema():
     """ Apply our password validator function when updating a user.
     """
-    user_schema = DEFAULT_UPDATE_USER_SCHEMA
-    user_schema = _apply_schema_validator(user_schema, 'password')
-    _remove_schema_validator(user_schema, 'fullname', ignore_missing)
-    user_schema = _apply_schema_validator(
-        user_schema, 'fullname',
-        validator_name='not_empty', validator=not_empty)
-    user_schema = user_creation_helpers.add_custom_validator_to_user_schema(user_schema)
-    return user_schema
+    return _get_schema('default_update_user_schema')
 
 
 def default_resource_schema():
     """ Add URL validators to the default resource schema.
     """
-    resource_schema = RESOURCE_SCHEMA.copy()
-    # We can't make an entirely shallow copy, or else it will be permanently
-    # modified by eg schema.default_show_package_schema, but we don't want
-    # infinite depth either.
-    for key in resource_schema:
-        resource_schema[key] = resource_schema[key][:]
-    resource_schema['url'].append(get_validator('valid_url'))
-    return resource_schema
+    return _get_schema('default_resource_schema')
 
 
 @chained_action
@@ -187,9 +224,11 @@ def user_show(original_action, context, data_dict):
 @chained_action
 def user_update(original_action, context, data_dict):
     '''
-    Unlock an account when the password is reset.
+    Unlock an account when the password is reset,
+    and recognise its new name if it was renamed.
     '''
     return_value = original_action(context, data_dict)
+    forget_unknown_user(data_dict.get('name'))
     if u'reset_key' in data_dict:
         account_id = get_or_bust(data_dict, 'id')
         unlock_account(account_id)
@@ -0,0 +1,131 @@
+# encoding: utf-8
+""" Retrieval of CSV validation schemas for display.
+
+Schemas are cached per resource and version. Remote schemas are
+revalidated with conditional requests once they are older than
+'ckanext.qgov.json_schema.revalidate_after' seconds; uploaded schemas
+are read straight from CKAN's storage, rather than over HTTP.
+"""
+
+import copy
+import io
+import json
+from logging import getLogger
+import os
+import time
+
+import requests
+
+from ckan.lib import uploader
+
+from .caching import LRUCache
+from .http_session import ProcessSession
+
+LOG = getLogger(__name__)
+
+TIMEOUT = (2, 5)
+POOL_SIZE = 10
+REVALIDATE_AFTER = 300
+
+FETCH_ERROR = {"error": "Failed to retrieve json schema"}
+PARSE_ERROR = {"error": "Failed to parse json schema"}
+
+# schemas have always been retrieved without certificate checks
+_SESSION = ProcessSession(pool_size=POOL_SIZE, verify=False)
+
+# (resource ID, last modified) -> {'schema', 'etag', 'last_modified', 'checked', 'local'}
+_CACHE = LRUCache(max_size=500)
+
+
+def configure(config):
+    global TIMEOUT, REVALIDATE_AFTER
+
+    TIMEOUT = (float(config.get('ckanext.qgov.json_schema.connect_timeout', 2)),
+               float(config.get('ckanext.qgov.json_schema.read_timeout', 5)))
+    REVALIDATE_AFTER = int(config.get('ckanext.qgov.json_schema.revalidate_after', 300))
+
+
+def get_session():
+    """ Retrieve the HTTP session for this process.
+    """
+    return _SESSION.get()
+
+
+def _upload_path(resource):
+    """ Find the local file holding an uploaded resource, if any.
+    """
+    if resource.get('url_type') != 'upload':
+        return None
+    upload = uploader.get_resource_uploader(resource)
+    get_path = getattr(upload, 'get_path', None)
+    if get_path is None:
+        return None
+    path = get_path(resource['id'])
+    return path if path and os.path.isfile(path) else None
+
+
+def _read_upload(path):
+    try:
+        with io.open(path, encoding='utf-8') as schema_file:
+            schema = json.load(schema_file)
+    except OSError as e:
+        LOG.warning("Failed to read JSON schema from %s: %s", path, e)
+        return None
+    except ValueError:
+        schema = PARSE_ERROR
+    # a new upload changes the resource's last_modified, and so the cache key
+    return {'schema': schema, 'etag': None, 'last_modified': None,
+            'checked': time.time(), 'local': True}
+
+
+def _fetch(url, cached):
+    """ Retrieve a schema over HTTP, revalidating any cached copy.
+    Returns a cache entry, or None if the schema could not be retrieved.
+    """
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        LOG.warning("Failed to retrieve JSON schema from %s: %s", url, e)
+        return None
+    if response.status_code == requests.codes.not_modified and cached:
+        return dict(cached, checked=time.time())
+    if response.status_code != requests.codes.ok:
+        LOG.warning("Failed to retrieve JSON schema from %s: HTTP %s", url, response.status_code)
+        return None
+    try:
+        schema = json.loads(response.text)
+    except ValueError:
+        schema = PARSE_ERROR
+    return {'schema': schema,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'checked': time.time(),
+            'local': False}
+
+
+def get_schema(resource):
+    """ Retrieve the JSON validation schema held in a resource,
+    or a dict with an 'error' message.
+    """
+    key = (resource['id'], resource.get('last_modified') or resource.get('metadata_modified'))
+    cached = _CACHE.get(key)
+    if cached and (cached['local'] or cached['checked'] + REVALIDATE_AFTER > time.time()):
+        return copy.deepcopy(cached['schema'])
+
+    path = _upload_path(resource)
+    entry = _read_upload(path) if path else _fetch(resource.get('url'), cached)
+    if entry is None:
+        # serve a stale copy rather than nothing
+        return copy.deepcopy(cached['schema'] if cached else FETCH_ERROR)
+    _CACHE.set(key, entry)
+    return copy.deepcopy(entry['schema'])
+
+
+def clear_cache():
+    _CACHE.clear()
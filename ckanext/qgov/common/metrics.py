@@ -0,0 +1,111 @@
+# encoding: utf-8
+""" Site-wide counters for login activity, kept in a Redis hash
+so that every web worker contributes to the same totals.
+
+Increments are queued on pipelines that are already being sent,
+so instrumentation does not add round trips to Redis.
+"""
+
+from logging import getLogger
+from threading import Lock
+
+from redis.exceptions import RedisError
+
+from ckan.lib.redis import connect_to_redis
+
+from .caching import cache_key
+
+LOG = getLogger(__name__)
+
+LOGIN_ATTEMPTS = 'login_attempts_total'
+LOGIN_FAILURES = 'login_failures_total'
+LOGIN_LOCKOUTS = 'login_lockouts_total'
+REDIS_OPERATIONS = 'redis_operations_total'
+REDIS_SECONDS = 'redis_seconds_total'
+
+METRICS = (
+    (LOGIN_ATTEMPTS, 'Login attempts.'),
+    (LOGIN_FAILURES, 'Failed login attempts, including locked out and throttled ones.'),
+    (LOGIN_LOCKOUTS, 'Accounts or clients that reached a login limit and were locked out.'),
+    (REDIS_OPERATIONS, 'Redis round trips made by the rate limiter.'),
+    (REDIS_SECONDS, 'Time spent waiting for the rate limiter\'s Redis round trips.'),
+)
+
+# latency is only known after a round trip completes,
+# so it is held here until the next one
+_PENDING_LATENCY = [0, 0.0]
+_PENDING_LOCK = Lock()
+
+
+def metrics_key():
+    """ The Redis hash holding the counters.
+    """
+    return cache_key('metrics')
+
+
+def observe_latency(seconds):
+    """ Record the duration of a Redis round trip.
+    """
+    with _PENDING_LOCK:
+        _PENDING_LATENCY[0] += 1
+        _PENDING_LATENCY[1] += seconds
+
+
+def queue(pipe, *names):
+    """ Add increments of the named counters, and any pending
+    latency observations, to a Redis pipeline.
+    """
+    key = metrics_key()
+    for name in names:
+        pipe.hincrby(key, name, 1)
+    with _PENDING_LOCK:
+        operations, seconds = _PENDING_LATENCY
+        _PENDING_LATENCY[:] = [0, 0.0]
+    if operations:
+        pipe.hincrby(key, REDIS_OPERATIONS, operations)
+        pipe.hincrbyfloat(key, REDIS_SECONDS, seconds)
+
+
+def increment(*names):
+    """ Increment the named counters in their own round trip.
+    """
+    try:
+        pipe = connect_to_redis().pipeline(transaction=False)
+        queue(pipe, *names)
+        pipe.execute()
+    except RedisError as e:
+        LOG.warning("Unable to record metrics %s: %s", names, e)
+
+
+def read():
+    """ Retrieve the current value of every counter,
+    or None if Redis is unavailable.
+    """
+    try:
+        values = connect_to_redis().hgetall(metrics_key())
+    except RedisError as e:
+        LOG.warning("Unable to read metrics: %s", e)
+        return None
+    values = {
+        (name.decode('utf-8') if isinstance(name, bytes) else name): float(value)
+        for name, value in values.items()}
+    return [(name, description, values.get(name, 0))
+            for name, description in METRICS]
+
+
+def prometheus_text():
+    """ Render the counters in the Prometheus text exposition format.
+    If they can't be read, only the scrape error gauge is reported.
+    """
+    counters = read()
+    lines = [
+        '# HELP ckanext_qgov_scrape_error Whether the counters could not be read from Redis.',
+        '# TYPE ckanext_qgov_scrape_error gauge',
+        'ckanext_qgov_scrape_error {}'.format(0 if counters is not None else 1),
+    ]
+    for name, description, value in counters or []:
+        metric = 'ckanext_qgov_' + name
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} counter'.format(metric))
+        lines.append('{} {}'.format(metric, int(value) if value == int(value) else value))
+    return '\n'.join(lines) + '\n'
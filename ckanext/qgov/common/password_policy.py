@@ -0,0 +1,150 @@
+# encoding: utf-8
+""" Password strength rules, compiled once from config.
+
+A policy checks length, required patterns, the number of character
+classes used, an estimate of the password's entropy, and optionally
+a local list of breached passwords. Failures are reported as
+(message, parameters) pairs, each message at most once, so that
+callers can translate them.
+"""
+
+import math
+import re
+import string
+
+from .breached_passwords import BreachedPasswords
+
+DEFAULT_PATTERNS = r'.*[0-9].*,.*[a-z].*,.*[A-Z].*,.*[-`~!@#$%^&*()_+=|\\/ ].*'
+
+TOO_SHORT = 'Your password must be {min} characters or longer'
+TOO_LONG = 'Your password must be {max} characters or shorter'
+MISSING_PATTERN = 'Must contain at least one number, lowercase letter, capital letter, and symbol'
+TOO_FEW_CLASSES = 'Must contain at least {count} of the following: numbers, ' \
+    'lowercase letters, capital letters, and symbols'
+TOO_PREDICTABLE = 'Your password is too easy to guess. Please use a longer or more varied password'
+BREACHED = 'This password has appeared in a data breach, so it is not safe to use. ' \
+    'Please choose a different password'
+
+DIGIT = 'digit'
+LOWER = 'lower'
+UPPER = 'upper'
+SYMBOL = 'symbol'
+OTHER = 'other'
+
+# number of possible characters in each class, for estimating entropy
+CLASS_SIZES = {
+    DIGIT: len(string.digits),
+    LOWER: len(string.ascii_lowercase),
+    UPPER: len(string.ascii_uppercase),
+    SYMBOL: len(string.punctuation) + 1,
+    OTHER: 100,
+}
+
+
+def _character_class(char):
+    if char in string.digits:
+        return DIGIT
+    if char in string.ascii_lowercase:
+        return LOWER
+    if char in string.ascii_uppercase:
+        return UPPER
+    if ord(char) < 128:
+        return SYMBOL
+    return OTHER
+
+
+def _is_escaped(pattern, index):
+    """ Check whether the character at 'index' is preceded by an odd
+    number of backslashes.
+    """
+    backslashes = 0
+    while index > backslashes and pattern[index - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def strip_wildcards(pattern):
+    """ Remove leading and trailing '.*' from a pattern.
+    They make no difference to whether re.search finds a match,
+    but cause needless backtracking.
+    """
+    pattern = pattern.strip()
+    while pattern.startswith('.*'):
+        pattern = pattern[2:]
+    while pattern.endswith('.*') and not _is_escaped(pattern, len(pattern) - 2):
+        pattern = pattern[:-2]
+    return pattern
+
+
+def character_classes(password):
+    """ Find which character classes appear in a password,
+    in a single pass.
+    """
+    classes = set()
+    for char in password:
+        classes.add(_character_class(char))
+        if len(classes) == len(CLASS_SIZES):
+            break
+    return classes
+
+
+def entropy_bits(password, classes=None):
+    """ Estimate the entropy of a password from its length and the
+    size of the character classes it draws upon.
+    """
+    if not password:
+        return 0.0
+    if classes is None:
+        classes = character_classes(password)
+    pool_size = sum(CLASS_SIZES[character_class] for character_class in classes)
+    return len(password) * math.log(pool_size, 2)
+
+
+class PasswordPolicy(object):
+    """ A set of password rules. Zero disables a numeric rule.
+    """
+
+    def __init__(self, min_length=10, max_length=0, patterns=(),
+                 min_character_classes=0, min_entropy=0, breached_hashes_file=None):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.patterns = [re.compile(strip_wildcards(pattern)) for pattern in patterns]
+        self.min_character_classes = min_character_classes
+        self.min_entropy = min_entropy
+        self.breached_passwords = BreachedPasswords(breached_hashes_file) \
+            if breached_hashes_file else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            min_length=int(config.get('password_min_length', '10')),
+            max_length=int(config.get('password_max_length', '0')),
+            patterns=config.get('password_patterns', DEFAULT_PATTERNS).split(','),
+            min_character_classes=int(config.get('password_min_character_classes', '0')),
+            min_entropy=float(config.get('password_min_entropy', '0')),
+            breached_hashes_file=config.get('password_breached_hashes_file'),
+        )
+
+    def validate(self, password):
+        """ Check a password against the policy.
+        Returns a list of (message, parameters) for each failed rule.
+        """
+        if len(password) < self.min_length:
+            return [(TOO_SHORT, {'min': self.min_length})]
+        if self.max_length and len(password) > self.max_length:
+            return [(TOO_LONG, {'max': self.max_length})]
+
+        failures = []
+        for pattern in self.patterns:
+            if not pattern.search(password):
+                failures.append((MISSING_PATTERN, {}))
+                break
+        if self.min_character_classes or self.min_entropy:
+            classes = character_classes(password)
+            if len(classes) < self.min_character_classes:
+                failures.append((TOO_FEW_CLASSES, {'count': self.min_character_classes}))
+            if self.min_entropy and entropy_bits(password, classes) < self.min_entropy:
+                failures.append((TOO_PREDICTABLE, {}))
+        if self.breached_passwords is not None and self.breached_passwords.is_breached(password):
+            failures.append((BREACHED, {}))
+        return failures
@@ -14,10 +14,11 @@ from ckan.lib.base import h
 import ckan.lib.navl.dictization_functions as df
 from ckan.lib.navl.validators import unicode_safe
 from ckan.plugins import implements, SingletonPlugin
-from ckan.plugins.toolkit import _, add_template_directory, get_action, \
-    get_validator, render
+from ckan.plugins.toolkit import _, add_ckan_admin_tab, add_template_directory, \
+    get_action, get_validator, render
 
-from . import authenticator, auth_functions as auth, helpers, intercepts, urlm
+from . import activity, authenticator, auth_functions as auth, cli, counters, \
+    helpers, intercepts, json_schema, stats, tables, urlm
 from .stats import Stats
 from .user_creation import validators as user_creation_validators
 from .user_creation.logic.actions import create as user_creation_create_actions
@@ -69,9 +70,12 @@ class QGOVPlugin(SingletonPlugin):
     implements(plugins.IAuthFunctions, inherit=True)
     implements(plugins.IValidators, inherit=True)
     implements(plugins.IResourceController, inherit=True)
+    implements(plugins.IPackageController, inherit=True)
+    implements(plugins.IOrganizationController, inherit=True)
     implements(plugins.IMiddleware, inherit=True)
     implements(plugins.IBlueprint)
     implements(plugins.ITranslation, inherit=True)
+    implements(plugins.IClick)
 
     # IConfigurer
 
@@ -111,6 +115,7 @@ class QGOVPlugin(SingletonPlugin):
 
         # include templates
         add_template_directory(ckan_config, 'templates')
+        add_ckan_admin_tab(ckan_config, 'qgov_metrics.locked_accounts', 'Locked accounts')
 
         # block unwanted content
         ckan_config['openid_enabled'] = False
@@ -119,7 +124,7 @@ class QGOVPlugin(SingletonPlugin):
         urlm_path = ckan_config.get('urlm.app_path', None)
         if urlm_path:
             urlm_proxy = ckan_config.get('urlm.proxy', None)
-            urlm.configure_urlm(urlm_path, urlm_proxy)
+            urlm.configure_urlm(urlm_path, urlm_proxy, ckan_config)
         else:
             possible_urlm_path = os.path.join(here, 'resources', 'urlm.json')
             if os.path.isfile(possible_urlm_path):
@@ -132,7 +137,7 @@ class QGOVPlugin(SingletonPlugin):
                 if hostname in urlm_json:
                     urlm_url = urlm_json[hostname].get('url', '')
                     urlm_proxy = urlm_json[hostname].get('proxy', None)
-                    urlm.configure_urlm(urlm_url, urlm_proxy)
+                    urlm.configure_urlm(urlm_url, urlm_proxy, ckan_config)
 
         return ckan_config
 
@@ -145,6 +150,9 @@ class QGOVPlugin(SingletonPlugin):
         authenticator.intercept_authenticator()
         intercepts.configure(config)
         intercepts.set_intercepts()
+        tables.configure_tables()
+        activity.configure(config)
+        json_schema.configure(config)
 
     # IMiddleware
 
@@ -153,7 +161,7 @@ class QGOVPlugin(SingletonPlugin):
             @app.errorhandler(404)
             def handle_not_found(e):
                 from flask import redirect, request, get_flashed_messages
-                redirect_url = urlm.get_purl_response(request.base_url)
+                redirect_url = urlm.resolve_purl(request.base_url)
                 if redirect_url:
                     # eat the 'page not found' message as it's obsolete
                     get_flashed_messages()
@@ -177,9 +185,11 @@ class QGOVPlugin(SingletonPlugin):
         user to the `came_from` URL if they are logged in.
         :return:
         """
-        from .views import user, assets
+        from .views import user, assets, metrics as metrics_views, stats as stats_views
         blueprints = user.get_blueprints()
         blueprints.extend(assets.get_blueprints())
+        blueprints.extend(stats_views.get_blueprints())
+        blueprints.extend(metrics_views.get_blueprints())
         return blueprints
 
     # ITemplateHelpers
@@ -189,11 +199,11 @@ class QGOVPlugin(SingletonPlugin):
         to provide QGOV-specific helpers to the templates.
         """
         return {
-            'top_organisations': Stats.top_organisations,
-            'top_categories': Stats.top_categories,
-            'resource_count': Stats.resource_count,
+            'top_organisations': stats.cached_top_organisations,
+            'top_categories': stats.cached_top_categories,
+            'resource_count': stats.cached_resource_count,
             'resource_report': Stats.resource_report,
-            'resource_org_count': Stats.resource_org_count,
+            'resource_org_count': stats.cached_resource_org_count,
             'random_tags': helpers.random_tags,
             'format_resource_filesize': helpers.format_resource_filesize,
             'group_id_for': helpers.group_id_for,
@@ -203,6 +213,7 @@ class QGOVPlugin(SingletonPlugin):
             'generate_download_url': helpers.generate_download_url,
             'generate_json_schema': helpers.generate_json_schema,
             'data_qld_organisation_list': helpers.organisation_list,
+            'data_qld_organisation_summary_list': helpers.organisation_summary_list,
             'data_qld_user_has_admin_access': helpers.user_has_admin_access,
             'data_qld_format_activity_data': helpers.format_activity_data,
             'activity_type_nice': helpers.activity_type_nice,
@@ -251,7 +262,7 @@ class QGOVPlugin(SingletonPlugin):
 
     # IResourceController
 
-    def after_create(self, context, data_dict):
+    def after_resource_create(self, context, data_dict):
         # Set the resource position order for this (latest) resource to first
         resource_id = data_dict.get('id', None)
         package_id = data_dict.get('package_id', None)
@@ -260,8 +271,56 @@ class QGOVPlugin(SingletonPlugin):
                 get_action('package_resource_reorder')(context, {'id': package_id, 'order': [resource_id]})
             except Exception as e:
                 LOG.error("Failed to move new resource to first position: %s", e)
+        counters.sync_package(package_id)
+        helpers.forget_packages()
+
+    def after_resource_update(self, context, data_dict):
+        counters.sync_package(data_dict.get('package_id', None))
+        helpers.forget_packages()
+
+    def after_resource_delete(self, context, resources):
+        # we receive the remaining resources; if there are none,
+        # the package update will already have synchronised the counters
+        if resources:
+            counters.sync_package(resources[0].get('package_id', None))
+        helpers.forget_packages()
+
+    # IPackageController
+
+    def after_dataset_create(self, context, pkg_dict):
+        counters.sync_package(pkg_dict.get('id', None))
+        helpers.forget_packages()
+
+    def after_dataset_update(self, context, pkg_dict):
+        counters.sync_package(pkg_dict.get('id', None))
+        helpers.forget_packages()
+
+    def after_dataset_delete(self, context, pkg_dict):
+        counters.sync_package(pkg_dict.get('id', None))
+        helpers.forget_packages()
+
+    # IOrganizationController
+    # These share their names with IPackageController hooks,
+    # so check what kind of entity has changed.
+
+    def create(self, entity):
+        if getattr(entity, 'is_organization', False):
+            helpers.forget_organisations()
+
+    def edit(self, entity):
+        if getattr(entity, 'is_organization', False):
+            helpers.forget_organisations()
+
+    def delete(self, entity):
+        if getattr(entity, 'is_organization', False):
+            helpers.forget_organisations()
 
     # ITranslation
 
     def i18n_directory(self):
         return os.path.join(os.path.dirname(__file__), 'i18n')
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
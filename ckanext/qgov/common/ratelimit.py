@@ -0,0 +1,299 @@
+# encoding: utf-8
+""" Redis-backed sliding window rate limiting, shared by login
+and password reset.
+
+Each endpoint can be limited per client IP address and per account,
+eg 'ckanext.qgov.ratelimit.login.account = 10/1800' allows ten failed
+logins per account in any 30 minute window. Clients that keep trying
+after reaching a limit are also blocked for an exponentially growing
+period. Limits of 0 disable the corresponding rule.
+
+Per-IP limits are disabled by default, since behind a proxy or load
+balancer every client would share one address. Set
+'ckanext.qgov.ratelimit.trusted_proxies' to the number of proxies in
+front of CKAN so that clients are identified from X-Forwarded-For.
+"""
+
+import hashlib
+from logging import getLogger
+import time
+import uuid
+
+from flask import has_request_context, request
+from redis.exceptions import NoScriptError, RedisError
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import config as ckan_config
+
+from . import metrics
+from .caching import cache_key
+
+LOG = getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    ('login', 'account'): '10/1800',
+    ('login', 'ip'): '0',
+    ('password_reset', 'account'): '5/3600',
+    ('password_reset', 'ip'): '0',
+}
+# the account lockout predates this module, so keep its keys
+KEY_PREFIXES = {
+    ('login', 'account'): ('login_attempts',),
+}
+BACKOFF_BASE = 1
+BACKOFF_MAX = 3600
+TRUSTED_PROXIES = 0
+
+RULES = None
+
+# KEYS: hit log (sorted set), backoff expiry, metrics hash
+# ARGV: now, window, limit, record (0/1), hit ID, backoff base, backoff max,
+# metric to increment when a recorded hit reaches the limit ('' for none)
+# Returns the number of milliseconds until the client may try again.
+SLIDING_WINDOW_SCRIPT = """
+local now, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+if redis.call('TYPE', KEYS[1]).ok == 'string' then
+    -- convert a plain counter from the old lockout implementation
+    local previous = tonumber(redis.call('GET', KEYS[1])) or 0
+    redis.call('DEL', KEYS[1])
+    for i = 1, math.min(previous, limit) do
+        redis.call('ZADD', KEYS[1], now, 'legacy-' .. i)
+    end
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+local retry_after = 0
+if count >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[1], count - limit, count - limit, 'WITHSCORES')
+    retry_after = tonumber(oldest[2]) + window - now
+end
+local blocked_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if blocked_until > now then
+    retry_after = math.max(retry_after, blocked_until - now)
+end
+if ARGV[4] == '1' then
+    redis.call('ZADD', KEYS[1], now, ARGV[5])
+    redis.call('PEXPIRE', KEYS[1], window)
+    local excess = count + 1 - limit
+    if excess == 0 and ARGV[8] ~= '' then
+        redis.call('HINCRBY', KEYS[3], ARGV[8], 1)
+    end
+    local base, max_delay = tonumber(ARGV[6]), tonumber(ARGV[7])
+    if excess > 0 and base > 0 then
+        local delay = math.min(max_delay, base * 2 ^ (excess - 1))
+        if now + delay > blocked_until then
+            redis.call('SET', KEYS[2], now + delay, 'PX', math.ceil(delay))
+        end
+    end
+end
+return math.ceil(retry_after)
+"""
+SLIDING_WINDOW_SHA = hashlib.sha1(SLIDING_WINDOW_SCRIPT.encode('utf-8')).hexdigest()
+
+
+def _parse_limit(value):
+    """ Parse a limit in the form 'attempts/seconds'.
+    """
+    if not value or '/' not in value:
+        return None
+    attempts, seconds = value.split('/', 1)
+    attempts, seconds = int(attempts), int(seconds)
+    if attempts <= 0 or seconds <= 0:
+        return None
+    return attempts, seconds
+
+
+def configure(config):
+    """ Read the rate limits from config.
+    """
+    global RULES, BACKOFF_BASE, BACKOFF_MAX, TRUSTED_PROXIES
+
+    RULES = {}
+    for (endpoint, scope), default in DEFAULT_LIMITS.items():
+        limit = _parse_limit(config.get(
+            'ckanext.qgov.ratelimit.{}.{}'.format(endpoint, scope), default))
+        if limit:
+            RULES[(endpoint, scope)] = limit
+    BACKOFF_BASE = float(config.get('ckanext.qgov.ratelimit.backoff_base', 1))
+    BACKOFF_MAX = float(config.get('ckanext.qgov.ratelimit.backoff_max', 3600))
+    TRUSTED_PROXIES = int(config.get('ckanext.qgov.ratelimit.trusted_proxies', 0))
+
+
+def client_ip():
+    """ Retrieve the address of the current client, if any.
+    Behind trusted proxies, this is the address that the outermost
+    one received the request from, as for werkzeug's ProxyFix.
+    """
+    if not has_request_context():
+        return None
+    if RULES is None:
+        configure(ckan_config)
+    if TRUSTED_PROXIES:
+        forwarded = [address.strip() for address in
+                     request.headers.get('X-Forwarded-For', '').split(',') if address.strip()]
+        if len(forwarded) >= TRUSTED_PROXIES:
+            return forwarded[-TRUSTED_PROXIES]
+    return request.remote_addr
+
+
+def rate_limit_key(endpoint, scope, identity):
+    prefix = KEY_PREFIXES.get((endpoint, scope), ('ratelimit', endpoint, scope))
+    return cache_key(*(prefix + (identity,)))
+
+
+def _rules(endpoint, identities):
+    if RULES is None:
+        configure(ckan_config)
+    for scope, identity in identities.items():
+        rule = RULES.get((endpoint, scope))
+        if rule and identity:
+            yield rate_limit_key(endpoint, scope, identity), rule
+
+
+def _queue_window(pipe, key, args):
+    pipe.evalsha(SLIDING_WINDOW_SHA, 3, key, key + '.backoff', metrics.metrics_key(), *args)
+
+
+def _execute(redis_conn, pipe, windows):
+    """ Execute a pipeline whose first commands are sliding window
+    checks, queued from the (key, args) pairs in 'windows'.
+
+    The script is called by its hash, so it is only sent to Redis
+    (and the affected checks repeated) if Redis doesn't know it yet.
+    """
+    results = pipe.execute(raise_on_error=False)
+    missing = [index for index, result in enumerate(results[:len(windows)])
+               if isinstance(result, NoScriptError)]
+    if missing:
+        redis_conn.script_load(SLIDING_WINDOW_SCRIPT)
+        retry = redis_conn.pipeline(transaction=False)
+        for index in missing:
+            _queue_window(retry, *windows[index])
+        for index, result in zip(missing, retry.execute()):
+            results[index] = result
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def _run(endpoint, identities, record, counters=(), limit_counter=None):
+    rules = list(_rules(endpoint, identities))
+    if not rules and not counters:
+        return 0
+    now = int(time.time() * 1000)
+    hit_id = '{}-{}'.format(now, uuid.uuid4().hex[:8])
+    windows = [(key, [now, window * 1000, limit, 1 if record else 0, hit_id,
+                      int(BACKOFF_BASE * 1000), int(BACKOFF_MAX * 1000), limit_counter or ''])
+               for key, (limit, window) in rules]
+    try:
+        redis_conn = connect_to_redis()
+        pipe = redis_conn.pipeline(transaction=False)
+        for key, args in windows:
+            _queue_window(pipe, key, args)
+        metrics.queue(pipe, *counters)
+        start = time.time()
+        results = _execute(redis_conn, pipe, windows)
+        metrics.observe_latency(time.time() - start)
+    except RedisError as e:
+        LOG.warning("Unable to apply rate limits for %s: %s", endpoint, e)
+        return 0
+    retry_after = max(results[:len(rules)] or [0])
+    if retry_after:
+        LOG.debug("Rate limit reached for %s %s, retry after %sms", endpoint, identities, retry_after)
+    return retry_after / 1000.0
+
+
+def check(endpoint, counters=(), **identities):
+    """ Check whether any of the identities (eg 'ip', 'account')
+    have reached their limit for the endpoint, without counting
+    this as an attempt.
+
+    Returns the number of seconds until another attempt will be
+    allowed, or 0 if the attempt may proceed.
+    Redis problems are logged and do not block the attempt.
+
+    Any 'counters' are incremented in the same round trip;
+    see the 'metrics' module.
+    """
+    return _run(endpoint, identities, record=False, counters=counters)
+
+
+def hit(endpoint, counters=(), limit_counter=None, **identities):
+    """ Count an attempt against each of the identities,
+    and check whether it should have been allowed.
+
+    Returns the number of seconds until another attempt will be
+    allowed, or 0 if this attempt may proceed.
+
+    If this attempt brings an identity to its limit,
+    'limit_counter' is incremented too.
+    """
+    return _run(endpoint, identities, record=True, counters=counters,
+                limit_counter=limit_counter)
+
+
+def reset(endpoint, counters=(), **identities):
+    """ Forget previous attempts by the identities, eg after a
+    successful login.
+    """
+    keys = []
+    for key, _rule in _rules(endpoint, identities):
+        keys.extend([key, key + '.backoff'])
+    if not keys and not counters:
+        return 0
+    try:
+        pipe = connect_to_redis().pipeline(transaction=False)
+        if keys:
+            pipe.delete(*keys)
+        metrics.queue(pipe, *counters)
+        start = time.time()
+        results = pipe.execute()
+        metrics.observe_latency(time.time() - start)
+    except RedisError as e:
+        LOG.warning("Unable to reset rate limits for %s: %s", endpoint, e)
+        return 0
+    return results[0] if keys else 0
+
+
+def blocked(endpoint, scope, batch_size=500):
+    """ Find the identities that have currently reached their limit
+    for an endpoint, eg locked accounts.
+
+    Keys are found with SCAN, so Redis is not blocked while they are
+    listed, and checked in batches of 'batch_size'.
+    Yields pairs of (identity, seconds until unblocked).
+    """
+    if RULES is None:
+        configure(ckan_config)
+    rule = RULES.get((endpoint, scope))
+    if not rule:
+        return
+    limit, window = rule
+    prefix = rate_limit_key(endpoint, scope, '')
+    redis_conn = connect_to_redis()
+
+    def _check_batch(keys):
+        now = int(time.time() * 1000)
+        windows = [(key, [now, window * 1000, limit, 0, '', 0, 0, '']) for key in keys]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key, args in windows:
+            _queue_window(pipe, key, args)
+        for key, retry_after in zip(keys, _execute(redis_conn, pipe, windows)):
+            if retry_after:
+                yield key[len(prefix):], retry_after / 1000.0
+
+    batch = []
+    for key in redis_conn.scan_iter(match=prefix + '*', count=batch_size):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        if key.endswith('.backoff'):
+            continue
+        batch.append(key)
+        if len(batch) >= batch_size:
+            for item in _check_batch(batch):
+                yield item
+            batch = []
+    if batch:
+        for item in _check_batch(batch):
+            yield item
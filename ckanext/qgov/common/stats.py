@@ -1,14 +1,45 @@
 # encoding: utf-8
 """ Extra statistics functions
 """
+from collections import namedtuple
+from logging import getLogger
+from threading import Lock, Thread
+import time
+
 from ckan import model
-from sqlalchemy import and_, func, select, Table
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import config
+from redis.exceptions import RedisError
+from sqlalchemy import and_, func, select
+
+from . import counters
+from .caching import cache_key, redis_get, redis_set, request_cache, LRUCache
+from .tables import table
+
+LOG = getLogger(__name__)
+
+# Redis keeps snapshots for this many multiples of the TTL,
+# so a stale copy can be served while it is being refreshed.
+SNAPSHOT_RETENTION = 10
+
+RESOURCE_REPORT_COLUMNS = ('organisation', 'dataset', 'resource', 'url', 'created',
+                           'last_modified', 'format', 'webstore_url', 'resource_type')
 
+_SNAPSHOTS = {}
+_SNAPSHOT_LOCK = Lock()
+_REFRESHING = set()
 
-def table(name):
-    """ Helper to construct an SQLAlchemy table object.
+_RESOURCE_ORG_COUNTS = LRUCache(max_size=1)
+
+
+class GroupSummary(namedtuple('GroupSummary', ['id', 'name', 'title', 'type', 'is_organization', 'image_url', 'state'])):
+    """ Lightweight, serialisable stand-in for a Group in statistics.
     """
-    return Table(name, model.meta.metadata, autoload=True)
+    __slots__ = ()
+
+    @property
+    def display_name(self):
+        return self.title or self.name
 
 
 class Stats(object):
@@ -21,9 +52,9 @@ class Stats(object):
         """
         member = table('member')
         package = table('package')
-        query = select(member.c.group_id, func.count(member.c.table_id)). \
+        counts = select(member.c.group_id, func.count(member.c.table_id).label('count')). \
             group_by(member.c.group_id). \
-            where(and_(member.c.group_id is not None,
+            where(and_(member.c.group_id.isnot(None),
                        member.c.table_name == 'package',
                        member.c.capacity == 'public',
                        member.c.state == 'active',
@@ -32,26 +63,39 @@ class Stats(object):
                        package.c.id == member.c.table_id
                        )). \
             order_by(func.count(member.c.table_id).desc()). \
-            limit(limit)
+            limit(limit). \
+            subquery()
 
-        res_ids = model.Session.execute(query).fetchall()
-        res_groups = [(model.Session.query(model.Group).get(str(group_id)), val) for group_id, val in res_ids]
-        return res_groups
+        return cls._with_groups(counts, counts.c.group_id)
 
     @classmethod
     def top_organisations(cls, limit=10):
         """ Displays the most-used organisations (by default, top 10).
         """
         package = table('package')
-        query = select(package.c.owner_org, func.count(package.c.owner_org)). \
+        counts = select(package.c.owner_org, func.count(package.c.owner_org).label('count')). \
             group_by(package.c.owner_org). \
-            where(and_(package.c.state == 'active', package.c.private == 'FALSE')). \
+            where(and_(package.c.owner_org.isnot(None),
+                       package.c.state == 'active',
+                       package.c.private == 'FALSE')). \
             order_by(func.count(package.c.owner_org).desc()). \
-            limit(limit)
+            limit(limit). \
+            subquery()
 
-        res_ids = model.Session.execute(query).fetchall()
-        res_groups = [(model.Session.query(model.Group).get(str(owner_org)), val) for owner_org, val in res_ids]
-        return res_groups
+        return cls._with_groups(counts, counts.c.owner_org)
+
+    @classmethod
+    def _with_groups(cls, counts, group_id_column):
+        """ Join aggregate (group ID, count) rows to their groups,
+        in a single query, and return (group summary, count) tuples.
+        """
+        group = table('group')
+        query = select(*[group.c[field] for field in GroupSummary._fields] + [counts.c.count]). \
+            where(group.c.id == group_id_column). \
+            order_by(counts.c.count.desc())
+
+        return [(GroupSummary(*row[:-1]), row[-1])
+                for row in model.Session.execute(query)]
 
     @classmethod
     def resource_count(cls):
@@ -70,21 +114,66 @@ class Stats(object):
         res_count = model.Session.execute(query).fetchall()
         return res_count[0][0]
 
+    @classmethod
+    def resource_org_counts(cls, org_ids=None):
+        """ Returns the number of resources in each organisation
+        (by default, all of them) as a dict, using a single query.
+        """
+        resource = table('resource')
+        package = table('package')
+        conditions = [resource.c.state == 'active',
+                      package.c.state == 'active',
+                      resource.c.package_id == package.c.id,
+                      package.c.owner_org.isnot(None),
+                      # Don't count priv datasets
+                      package.c.private != 'TRUE']
+        if org_ids is not None:
+            conditions.append(package.c.owner_org.in_(org_ids))
+        query = select(package.c.owner_org, func.count(resource.c.id)). \
+            where(and_(*conditions)). \
+            group_by(package.c.owner_org)
+
+        res_counts = dict(model.Session.execute(query).fetchall())
+        if org_ids is not None:
+            for org_id in org_ids:
+                res_counts.setdefault(org_id, 0)
+        return res_counts
+
     @classmethod
     def resource_report(cls):
         """ Displays information about each resource.
         """
+        res_report = model.Session.execute(cls._resource_report_query()).fetchall()
+        return res_report
+
+    @classmethod
+    def iter_resource_report(cls, chunk_size=1000):
+        """ Yields information about each resource, in the same form as
+        'resource_report', but fetches rows in batches from a server-side
+        cursor so that the whole report is never held in memory.
+        """
+        result = model.Session.execute(
+            cls._resource_report_query().execution_options(stream_results=True))
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            result.close()
+
+    @classmethod
+    def _resource_report_query(cls):
         resource = table('resource')
         group = table('group')
         package = table('package')
-        query = select(group.c.title, package.c.title, resource.c.name, resource.c.url, resource.c.created, resource.c.last_modified, resource.c.format, resource.c.webstore_url if hasattr(resource.c, 'webstore_url') else None, resource.c.resource_type). \
+        return select(group.c.title, package.c.title, resource.c.name, resource.c.url, resource.c.created, resource.c.last_modified, resource.c.format, resource.c.webstore_url if hasattr(resource.c, 'webstore_url') else None, resource.c.resource_type). \
             where(and_(resource.c.package_id == package.c.id,
                        resource.c.state == 'active',
                        group.c.id == package.c.owner_org))
 
-        res_report = model.Session.execute(query).fetchall()
-        return res_report
-
     @classmethod
     def resource_org_count(cls, org_id):
         """ Displays the number of resources in an organisation.
@@ -102,3 +191,194 @@ class Stats(object):
 
         res_count = model.Session.execute(query).fetchall()
         return res_count[0][0]
+
+
+# Snapshots of the expensive aggregate queries, for use in templates.
+
+_SNAPSHOT_QUERIES = {
+    'top_categories': Stats.top_categories,
+    'top_organisations': Stats.top_organisations,
+}
+
+
+def _snapshot_ttl():
+    return int(config.get('ckanext.qgov.stats.cache_ttl', 600))
+
+
+def _get_snapshot(name, limit):
+    """ Retrieve the rows for an aggregate query.
+
+    Results are held in memory and in Redis. Once they are older than
+    the configured TTL, they continue to be served while a background
+    thread recomputes them, so page renders only block on the query
+    if no snapshot exists anywhere.
+    """
+    ttl = _snapshot_ttl()
+    if ttl <= 0:
+        return _SNAPSHOT_QUERIES[name](limit)
+
+    now = time.time()
+    snapshot = _SNAPSHOTS.get((name, limit))
+    if snapshot is None or snapshot['computed'] + ttl < now:
+        shared = redis_get(cache_key('stats', name, limit))
+        if shared and (snapshot is None or shared['computed'] > snapshot['computed']):
+            snapshot = _SNAPSHOTS[(name, limit)] = shared
+    if snapshot is None:
+        snapshot = _refresh_snapshot(name, limit)
+    elif snapshot['computed'] + ttl < now:
+        _schedule_refresh(name, limit)
+    return [(GroupSummary(*group), val) for group, val in snapshot['rows']]
+
+
+def _refresh_snapshot(name, limit):
+    """ Run an aggregate query and store the results.
+    """
+    snapshot = {
+        'computed': time.time(),
+        'rows': [[list(group), val] for group, val in _SNAPSHOT_QUERIES[name](limit)]
+    }
+    _SNAPSHOTS[(name, limit)] = snapshot
+    redis_set(cache_key('stats', name, limit), snapshot,
+              ttl=_snapshot_ttl() * SNAPSHOT_RETENTION)
+    return snapshot
+
+
+def _schedule_refresh(name, limit):
+    """ Refresh a snapshot in a background thread, unless this or
+    another worker is already doing so.
+    """
+    with _SNAPSHOT_LOCK:
+        if (name, limit) in _REFRESHING:
+            return
+        _REFRESHING.add((name, limit))
+    # released by the refresh thread, so the token can't be thread-local
+    lock = None
+    try:
+        lock = connect_to_redis().lock(
+            cache_key('stats', name, limit, 'lock'),
+            timeout=_snapshot_ttl(), thread_local=False)
+        acquired = lock.acquire(blocking=False)
+    except RedisError as e:
+        LOG.warning("Unable to lock %s statistics for refresh: %s", name, e)
+        lock = None
+        acquired = True
+    if not acquired:
+        LOG.debug("%s statistics are already being refreshed", name)
+        with _SNAPSHOT_LOCK:
+            _REFRESHING.discard((name, limit))
+        return
+
+    def refresh():
+        try:
+            _refresh_snapshot(name, limit)
+        except Exception as e:
+            LOG.error("Failed to refresh %s statistics: %s", name, e)
+        finally:
+            model.Session.remove()
+            with _SNAPSHOT_LOCK:
+                _REFRESHING.discard((name, limit))
+            if lock is not None:
+                try:
+                    lock.release()
+                except RedisError:
+                    # expired, and perhaps taken by another worker
+                    pass
+
+    Thread(target=refresh, name='qgov-stats-{}'.format(name), daemon=True).start()
+
+
+def clear_snapshots():
+    """ Discard all cached statistics, locally and in Redis.
+    """
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOTS.clear()
+    _RESOURCE_ORG_COUNTS.clear()
+    try:
+        redis_conn = connect_to_redis()
+        keys = list(redis_conn.scan_iter(match=cache_key('stats', '*')))
+        if keys:
+            redis_conn.delete(*keys)
+    except RedisError as e:
+        LOG.warning("Unable to clear cached statistics: %s", e)
+
+
+def cached_top_categories(limit=10):
+    """ Template helper for the most-used categories, using snapshots.
+    """
+    return _get_snapshot('top_categories', limit)
+
+
+def cached_top_organisations(limit=10):
+    """ Template helper for the most-used organisations, using snapshots.
+    """
+    return _get_snapshot('top_organisations', limit)
+
+
+def cached_resource_org_counts():
+    """ Retrieve the resource counts for all organisations.
+
+    These are read from the incremental counters, if enabled, or else
+    calculated at most once per request, and optionally shared between
+    requests for 'ckanext.qgov.stats.resource_org_counts_ttl' seconds,
+    so organisation listings don't query each one separately.
+    """
+    cache = request_cache('stats')
+    if 'resource_org_counts' not in cache:
+        counts = None
+        if counters.enabled():
+            counts = counters.resource_org_counts()
+            if counts is None:
+                counts = _reconcile_counters()[1]
+        if counts is None:
+            counts = _shared_resource_org_counts()
+        cache['resource_org_counts'] = counts
+    return cache['resource_org_counts']
+
+
+def _shared_resource_org_counts():
+    ttl = int(config.get('ckanext.qgov.stats.resource_org_counts_ttl', 0))
+    if ttl <= 0:
+        return Stats.resource_org_counts()
+
+    counts = _RESOURCE_ORG_COUNTS.get('all')
+    if counts is not None:
+        return counts
+    counts = redis_get(cache_key('stats', 'resource_org_counts'))
+    if counts is None:
+        counts = Stats.resource_org_counts()
+        redis_set(cache_key('stats', 'resource_org_counts'), counts, ttl=ttl)
+    # only store fresh values, so that the local copy expires on time
+    _RESOURCE_ORG_COUNTS.set('all', counts, ttl=ttl)
+    return counts
+
+
+def _reconcile_counters():
+    """ Initialise the incremental counters from the database.
+    Returns (None, None) if they could not be stored, or another
+    worker is already initialising them.
+    """
+    try:
+        return counters.reconcile_once()
+    except RedisError as e:
+        LOG.warning("Unable to initialise resource counters: %s", e)
+        return None, None
+
+
+def cached_resource_org_count(org_id):
+    """ Template helper for the number of resources in an organisation.
+    """
+    return cached_resource_org_counts().get(org_id, 0)
+
+
+def cached_resource_count():
+    """ Template helper for the number of resources in public datasets.
+    If incremental counters are enabled, this is read from Redis.
+    """
+    count = None
+    if counters.enabled():
+        count = counters.resource_count()
+        if count is None:
+            count = _reconcile_counters()[0]
+    if count is None:
+        count = Stats.resource_count()
+    return count
@@ -0,0 +1,52 @@
+# encoding: utf-8
+""" Registry of the database tables queried for statistics.
+"""
+from logging import getLogger
+from threading import Lock
+
+from ckan import model
+from sqlalchemy import MetaData, Table
+from sqlalchemy.exc import SQLAlchemyError
+
+LOG = getLogger(__name__)
+
+STATS_TABLES = ('group', 'member', 'package', 'resource')
+
+_TABLES = {}
+_TABLES_LOCK = Lock()
+
+
+def configure_tables():
+    """ Reflect the tables used for statistics, once per process,
+    so that helpers don't need to inspect the database on each call.
+    If the database is not available, eg during initialisation,
+    the ORM-mapped tables from CKAN's model are used instead.
+    """
+    metadata = MetaData()
+    try:
+        with model.meta.engine.connect() as connection:
+            metadata.reflect(bind=connection, only=STATS_TABLES)
+        tables = metadata.tables
+    except (AttributeError, SQLAlchemyError) as e:
+        LOG.warning("Unable to reflect statistics tables, using CKAN model: %s", e)
+        tables = model.meta.metadata.tables
+    with _TABLES_LOCK:
+        for name in STATS_TABLES:
+            if name in tables:
+                _TABLES[name] = tables[name]
+
+
+def table(name):
+    """ Helper to retrieve an SQLAlchemy table object.
+    """
+    try:
+        return _TABLES[name]
+    except KeyError:
+        pass
+    with _TABLES_LOCK:
+        if name not in _TABLES:
+            if name in model.meta.metadata.tables:
+                _TABLES[name] = model.meta.metadata.tables[name]
+            else:
+                _TABLES[name] = Table(name, model.meta.metadata, autoload_with=model.meta.engine)
+        return _TABLES[name]
@@ -0,0 +1,20 @@
+# encoding: utf-8
+
+import pytest
+from sqlalchemy import event
+
+from ckan import model
+
+
+@pytest.fixture()
+def statements():
+    """ Record the SQL statements sent to the database.
+    """
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(model.meta.engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(model.meta.engine, 'before_cursor_execute', record)
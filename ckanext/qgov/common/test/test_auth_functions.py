@@ -0,0 +1,70 @@
+# encoding: utf-8
+
+import pytest
+
+from ckan import model
+from ckan.tests import factories, helpers
+
+from ckanext.qgov.common import auth_functions
+
+
+def _is_admin(user):
+    return auth_functions._has_user_permission_for_some_group(user['name'], 'admin')
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestGroupPermissions(object):
+
+    def test_admin_of_active_organisation(self):
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': 'admin'}])
+        assert _is_admin(user)
+        assert auth_functions._has_user_permission_for_some_group(user['id'], 'admin')
+
+    def test_editor_is_not_admin(self):
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': 'editor'}])
+        assert not _is_admin(user)
+
+    def test_deleted_organisation_grants_nothing(self):
+        user = factories.User()
+        org = factories.Organization(users=[{'name': user['name'], 'capacity': 'admin'}])
+        helpers.call_action('organization_delete', id=org['id'])
+        assert not _is_admin(user)
+
+    def test_single_query_memoised_per_request(self, app, statements):
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': 'admin'}])
+        with app.flask_app.test_request_context():
+            del statements[:]
+            assert _is_admin(user)
+            assert len(statements) == 1
+            assert _is_admin(user)
+            assert len(statements) == 1
+
+    @pytest.mark.ckan_config('ckanext.qgov.auth_cache_ttl', '60')
+    def test_shared_cache_cleared_on_membership_change(self, statements):
+        user = factories.User()
+        org = factories.Organization()
+        assert not _is_admin(user)
+        del statements[:]
+        assert not _is_admin(user)
+        assert not statements
+
+        helpers.call_action('organization_member_create', id=org['id'],
+                            username=user['name'], role='admin')
+        assert _is_admin(user)
+
+    @pytest.mark.ckan_config('ckanext.qgov.auth_cache_ttl', '60')
+    def test_shared_cache_cleared_after_commit(self):
+        """ Test that a permission cached between flush and commit,
+        eg by another thread, is discarded.
+        """
+        user = factories.User()
+        org = factories.Organization()
+        model.Session.add(model.Member(table_name='user', table_id=user['id'], group_id=org['id'],
+                                       capacity='admin', state='active'))
+        model.Session.flush()
+        auth_functions._GROUP_PERMISSIONS.set((user['name'], 'admin'), False, 60)
+        model.Session.commit()
+        assert _is_admin(user)
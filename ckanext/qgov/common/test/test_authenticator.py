@@ -1,11 +1,17 @@
 # encoding: utf-8
 
+import uuid
+
+import mock
 import pytest
 
 from ckan.model import User
 from ckan.lib import authenticator as core_authenticator, create_test_data as ctd
 from ckan.plugins.toolkit import check_ckan_version
 
+from ckanext.qgov.common import authenticator
+from ckanext.qgov.common.authenticator import unlock_account
+
 if check_ckan_version('2.10'):
     from ckanext.qgov.common.authenticator import qgov_authenticate
 else:
@@ -76,3 +82,35 @@ class TestUsernamePasswordAuthenticator(object):
     )
     def test_authenticate_fails_if_incomplete_credentials(self, identity):
         assert qgov_authenticate(identity) is None
+
+    def test_account_locks_after_repeated_failures(self):
+        password = "somepass"
+        user = CreateTestData.create_user("user-{}".format(uuid.uuid4().hex[:8]), **{"password": password})
+        for _ in range(10):
+            assert qgov_authenticate({"login": user.name, "password": "wrong-password"}) is None
+        assert qgov_authenticate({"login": user.name, "password": password}) is None
+
+        unlock_account(user.id)
+        assert qgov_authenticate({"login": user.name, "password": password})
+
+    def test_locked_account_does_not_query_database(self):
+        password = "somepass"
+        user = CreateTestData.create_user("user-{}".format(uuid.uuid4().hex[:8]), **{"password": password})
+        for _ in range(10):
+            qgov_authenticate({"login": user.name, "password": "wrong-password"})
+
+        with mock.patch.object(User, 'by_name') as by_name:
+            assert qgov_authenticate({"login": user.name, "password": password}) is None
+        by_name.assert_not_called()
+        unlock_account(user.id)
+
+    def test_unknown_user_is_remembered_until_created(self):
+        login_name = "user-{}".format(uuid.uuid4().hex[:8])
+        assert qgov_authenticate({"login": login_name, "password": "somepass"}) is None
+        with mock.patch.object(User, 'by_name') as by_name:
+            assert qgov_authenticate({"login": login_name, "password": "somepass"}) is None
+        by_name.assert_not_called()
+
+        authenticator.forget_unknown_user(login_name)
+        user = CreateTestData.create_user(login_name, **{"password": "somepass"})
+        assert qgov_authenticate({"login": user.name, "password": "somepass"})
@@ -0,0 +1,202 @@
+# encoding: utf-8
+
+import uuid
+
+import mock
+import pytest
+
+from ckan import model
+from ckan.plugins.toolkit import config
+from ckan.tests import factories
+
+from ckanext.qgov.common import activity, helpers
+from ckanext.qgov.common.caching import cache_key, redis_set
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestUserHasAdminAccess(object):
+
+    def _has_access(self, user, include_editor_access):
+        with mock.patch.object(helpers.toolkit, 'current_user', model.User.get(user['id'])):
+            return helpers.user_has_admin_access(include_editor_access)
+
+    @pytest.mark.parametrize("capacity, admin_access, editor_access", [
+        ('admin', True, True),
+        ('editor', False, True),
+        ('member', False, False),
+    ])
+    def test_organisation_capacity(self, app, capacity, admin_access, editor_access):
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': capacity}])
+        with app.flask_app.test_request_context():
+            assert self._has_access(user, False) is admin_access
+            assert self._has_access(user, True) is editor_access
+
+    def test_group_membership_is_not_enough(self, app):
+        user = factories.User()
+        factories.Group(users=[{'name': user['name'], 'capacity': 'admin'}])
+        with app.flask_app.test_request_context():
+            assert not self._has_access(user, True)
+
+    def test_memoised_per_request(self, app, statements):
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': 'editor'}])
+        with app.flask_app.test_request_context():
+            self._has_access(user, True)
+            del statements[:]
+            for _ in range(100):
+                assert self._has_access(user, True)
+                assert not self._has_access(user, False)
+            assert not [statement for statement in statements if 'member' in statement]
+
+
+class TestFormatActivityData(object):
+
+    @pytest.fixture(autouse=True)
+    def anonymous(self):
+        with mock.patch.object(helpers, 'user_has_admin_access', return_value=False):
+            yield
+
+    def test_actor_is_replaced(self):
+        data = u'<li>\n  <span class="actor"><img src="/a.png?x=1&amp;y=2" /> ' \
+            u'<a href="/user/bob">Bob</a></span> updated <a href="/dataset/x">X &amp; Y</a>\n</li>'
+        assert helpers.format_activity_data(data) == \
+            u'<li>\n  <span class="actor" style="margin-left:-40px">Publisher</span> ' \
+            u'updated <a href="/dataset/x">X &amp; Y</a>\n</li>'
+
+    def test_other_markup_is_unchanged(self):
+        data = u"<p class='x'>Bob&#39;s <b>data</b><br><span class=\"actors\">keep</span></p>"
+        assert helpers.format_activity_data(data) == data
+
+    def test_nested_and_multiple_actors(self):
+        data = u'<div class="a actor" style="x"><div><i>Bob</i></div></div> and ' \
+            u'<span class="actor">Alice</span>'
+        assert helpers.format_activity_data(data) == \
+            u'<div class="a actor" style="margin-left:-40px">Publisher</div> and ' \
+            u'<span class="actor" style="margin-left:-40px">Publisher</span>'
+
+    def test_malformed_actor_markup(self):
+        data = u'<span class="actor"><p>Bob</span> y'
+        assert helpers.format_activity_data(data) == \
+            u'<span class="actor" style="margin-left:-40px">Publisher</span> y'
+        data = u'<span class="actor">Bob</div></span> updated <b>X</b>'
+        assert helpers.format_activity_data(data) == \
+            u'<span class="actor" style="margin-left:-40px">Publisher</span> updated <b>X</b>'
+
+    def test_admins_see_actors(self):
+        data = u'<span class="actor">Bob</span>'
+        with mock.patch.object(helpers, 'user_has_admin_access', return_value=True):
+            assert helpers.format_activity_data(data) == data
+
+
+class TestActivityFragmentCache(object):
+
+    @pytest.fixture(autouse=True)
+    def restore_config(self):
+        yield
+        activity.configure(config)
+
+    def _snippet(self):
+        return u'<span class="actor">{}</span> created a dataset'.format(uuid.uuid4().hex)
+
+    def _count_rewrites(self):
+        return mock.patch.object(activity.ActorRewriter, 'rewrite', autospec=True,
+                                 side_effect=activity.ActorRewriter.rewrite)
+
+    def test_repeated_snippets_are_parsed_once(self):
+        activity.configure({})
+        data = self._snippet()
+        with self._count_rewrites() as rewrite:
+            first = activity.anonymise_actors(data)
+            assert activity.anonymise_actors(data) == first
+        assert rewrite.call_count == 1
+        assert 'Publisher' in first
+
+    def test_redis_tier_is_shared(self):
+        activity.configure({'ckanext.qgov.activity_cache_size': '0',
+                            'ckanext.qgov.activity_cache_redis_ttl': '60'})
+        data = self._snippet()
+        with self._count_rewrites() as rewrite:
+            first = activity.anonymise_actors(data)
+            assert activity.anonymise_actors(data) == first
+        assert rewrite.call_count == 1
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestPackageHelpers(object):
+
+    @pytest.fixture
+    def dataset(self):
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'], name='Data', url='http://example.com/data.csv')
+        factories.Resource(package_id=dataset['id'], name='Schema', format='CSV VALIDATION SCHEMA',
+                           url='http://example.com/schema.json')
+        return helpers.get_action('package_show')({'ignore_auth': True}, {'id': dataset['id']})
+
+    def test_single_package_show_per_request(self, app, dataset):
+        data_resource, schema_resource = dataset['resources']
+        with app.flask_app.test_request_context():
+            with mock.patch.object(helpers, 'get_action', wraps=helpers.get_action) as get_action:
+                assert helpers.get_validation_resources({'id': dataset['name']}) == [schema_resource['id']]
+                assert helpers.get_resource_name(
+                    {'id': dataset['id'], 'resource_id': data_resource['id']}) == 'Data'
+                assert helpers.generate_download_url(dataset['id'], schema_resource['id']) == \
+                    'http://example.com/schema.json'
+            assert get_action.call_count == 1
+
+    def test_unknown_resource(self, app, dataset):
+        with app.flask_app.test_request_context():
+            assert helpers.get_resource_name({'id': dataset['id'], 'resource_id': 'missing'}) is None
+            assert helpers.generate_download_url(dataset['id'], 'missing') == ''
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestOrganisationSummaryList(object):
+
+    def _count_queries(self):
+        return mock.patch.object(helpers, '_query_organisation_summaries',
+                                 wraps=helpers._query_organisation_summaries)
+
+    def test_projection(self):
+        second = factories.Organization(title='B Organisation')
+        first = factories.Organization(title='A Organisation')
+        factories.Group()
+        assert helpers.organisation_summary_list() == [
+            {'id': first['id'], 'name': first['name'], 'title': 'A Organisation'},
+            {'id': second['id'], 'name': second['name'], 'title': 'B Organisation'},
+        ]
+        assert helpers.organisation_summary_list(fields=['name']) == [
+            {'name': first['name']}, {'name': second['name']}]
+
+    def test_cached_until_organisations_change(self):
+        organisation = factories.Organization(title='Original')
+        helpers.organisation_summary_list()
+        with self._count_queries() as query:
+            assert helpers.organisation_summary_list()[0]['title'] == 'Original'
+            assert query.call_count == 0
+
+            helpers.get_action('organization_patch')(
+                {'ignore_auth': True}, {'id': organisation['id'], 'title': 'Renamed'})
+            assert helpers.organisation_summary_list()[0]['title'] == 'Renamed'
+            assert query.call_count == 1
+
+            helpers.get_action('organization_delete')(
+                {'ignore_auth': True}, {'id': organisation['id']})
+            assert helpers.organisation_summary_list() == []
+
+    def test_invalidated_after_commit(self):
+        """ Test that a copy cached by another worker between the
+        hook and the commit is discarded.
+        """
+        organisation = factories.Organization(title='Original')
+        stale = [[organisation['id'], organisation['name'], 'Original']]
+        forget_organisations = helpers.forget_organisations
+
+        def forget_then_repopulate():
+            forget_organisations()
+            redis_set(cache_key('organisation_summaries'), stale, 3600)
+
+        with mock.patch.object(helpers, 'forget_organisations', side_effect=forget_then_repopulate):
+            helpers.get_action('organization_patch')(
+                {'ignore_auth': True}, {'id': organisation['id'], 'title': 'Renamed'})
+        assert helpers.organisation_summary_list()[0]['title'] == 'Renamed'
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+import pytest
+
+from ckan.lib.navl.validators import not_empty
+
+from ckanext.qgov.common import intercepts
+
+
+@pytest.mark.usefixtures("with_plugins")
+class TestSchemaRegistry(object):
+
+    @pytest.mark.parametrize("name", sorted(intercepts.SCHEMA_PATCHES))
+    def test_schemas_are_independent_copies(self, name):
+        schema_function = getattr(intercepts, name)
+        first = schema_function()
+        first[next(iter(first))].append(not_empty)
+        first['added_field'] = [not_empty]
+        second = schema_function()
+        assert 'added_field' not in second
+        assert second != first
+
+    def test_user_schemas_are_patched(self):
+        schema = intercepts.default_user_schema()
+        assert intercepts.user_password_validator in schema['password']
+        assert not_empty in schema['fullname']
+        update_schema = intercepts.default_update_user_schema()
+        assert 'data_qld_user_name_validator' in [
+            validator.__name__ for validator in update_schema['name']]
+
+    def test_resource_schema_validates_urls(self):
+        schema = intercepts.default_resource_schema()
+        assert 'valid_url' in [validator.__name__ for validator in schema['url']]
@@ -0,0 +1,88 @@
+# encoding: utf-8
+
+import time
+import uuid
+
+import mock
+import pytest
+
+from ckanext.qgov.common import json_schema
+
+
+def _resource(**kwargs):
+    resource = {'id': str(uuid.uuid4()), 'url': 'http://example.com/schema.json',
+                'url_type': '', 'last_modified': '2024-01-01T00:00:00'}
+    resource.update(kwargs)
+    return resource
+
+
+def _response(status_code, text='', headers=None):
+    return mock.Mock(status_code=status_code, text=text, headers=headers or {})
+
+
+class TestGetSchema(object):
+
+    @pytest.fixture(autouse=True)
+    def session(self):
+        json_schema.clear_cache()
+        session = mock.Mock()
+        with mock.patch.object(json_schema, 'get_session', return_value=session):
+            yield session
+        json_schema.clear_cache()
+
+    def test_schema_is_cached(self, session):
+        session.get.return_value = _response(200, '{"fields": []}')
+        resource = _resource()
+        assert json_schema.get_schema(resource) == {'fields': []}
+        assert json_schema.get_schema(resource) == {'fields': []}
+        assert session.get.call_count == 1
+
+    def test_stale_schema_is_revalidated(self, session):
+        session.get.return_value = _response(200, '{"fields": []}', {'ETag': '"v1"'})
+        resource = _resource()
+        json_schema.get_schema(resource)
+
+        session.get.return_value = _response(304)
+        with mock.patch.object(json_schema.time, 'time',
+                               return_value=time.time() + json_schema.REVALIDATE_AFTER + 1):
+            assert json_schema.get_schema(resource) == {'fields': []}
+        assert session.get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+    def test_new_version_is_fetched(self, session):
+        session.get.return_value = _response(200, '{"fields": []}')
+        resource = _resource()
+        json_schema.get_schema(resource)
+        json_schema.get_schema(dict(resource, last_modified='2024-02-01T00:00:00'))
+        assert session.get.call_count == 2
+        assert session.get.call_args[1]['headers'] == {}
+
+    def test_errors(self, session):
+        session.get.return_value = _response(404)
+        assert json_schema.get_schema(_resource()) == json_schema.FETCH_ERROR
+        session.get.return_value = _response(200, 'not JSON')
+        assert json_schema.get_schema(_resource()) == json_schema.PARSE_ERROR
+
+    def test_results_are_copies(self, session):
+        session.get.return_value = _response(200, '{"fields": []}')
+        resource = _resource()
+        json_schema.get_schema(resource)['fields'].append('changed')
+        assert json_schema.get_schema(resource) == {'fields': []}
+
+        session.get.return_value = _response(404)
+        json_schema.get_schema(_resource())['error'] = 'changed'
+        assert json_schema.get_schema(_resource()) == json_schema.FETCH_ERROR
+        assert json_schema.FETCH_ERROR == {"error": "Failed to retrieve json schema"}
+
+    def test_unreadable_upload(self, session, tmp_path):
+        path = tmp_path / 'schema.json'
+        path.mkdir()
+        with mock.patch.object(json_schema, '_upload_path', return_value=str(path)):
+            assert json_schema.get_schema(_resource(url_type='upload')) == json_schema.FETCH_ERROR
+
+    def test_uploads_are_read_locally(self, session, tmp_path):
+        path = tmp_path / 'schema.json'
+        path.write_text(u'{"fields": [{"name": "id"}]}')
+        with mock.patch.object(json_schema, '_upload_path', return_value=str(path)):
+            assert json_schema.get_schema(_resource(url_type='upload')) == \
+                {'fields': [{'name': 'id'}]}
+        assert not session.get.called
@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+import uuid
+
+import mock
+import pytest
+from redis.exceptions import RedisError
+
+from ckan.lib import create_test_data as ctd
+from ckan.tests import factories
+
+from ckanext.qgov.common import metrics, ratelimit
+from ckanext.qgov.common.authenticator import qgov_authenticate
+
+
+def _counters():
+    return {name: value for name, _description, value in metrics.read()}
+
+
+def _locked_user():
+    user = ctd.CreateTestData.create_user(
+        "user-{}".format(uuid.uuid4().hex[:8]), **{"password": "somepass"})
+    for _ in range(11):
+        qgov_authenticate({"login": user.name, "password": "wrong-password"})
+    return user
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestLoginMetrics(object):
+
+    def test_failed_logins_are_counted(self):
+        before = _counters()
+        _locked_user()
+        after = _counters()
+        assert after[metrics.LOGIN_ATTEMPTS] - before[metrics.LOGIN_ATTEMPTS] == 11
+        assert after[metrics.LOGIN_FAILURES] - before[metrics.LOGIN_FAILURES] == 11
+        assert after[metrics.LOGIN_LOCKOUTS] - before[metrics.LOGIN_LOCKOUTS] == 1
+        assert after[metrics.REDIS_OPERATIONS] > before[metrics.REDIS_OPERATIONS]
+
+    def test_lockouts_are_counted_once(self):
+        user = _locked_user()
+        before = _counters()
+        qgov_authenticate({"login": user.name, "password": "wrong-password"})
+        after = _counters()
+        assert after[metrics.LOGIN_FAILURES] - before[metrics.LOGIN_FAILURES] == 1
+        assert after[metrics.LOGIN_LOCKOUTS] == before[metrics.LOGIN_LOCKOUTS]
+
+    def test_metrics_without_redis(self):
+        with mock.patch.object(metrics, 'connect_to_redis', side_effect=RedisError('down')):
+            assert metrics.read() is None
+            text = metrics.prometheus_text()
+        assert 'ckanext_qgov_scrape_error 1' in text
+        assert metrics.LOGIN_ATTEMPTS not in text
+
+    def test_metrics_require_authorisation(self, app):
+        app.get('/ckan-admin/qgov-metrics', status=403)
+        app.get('/ckan-admin/qgov-metrics', headers={'Authorization': 'Bearer wrong'}, status=403)
+
+    @pytest.mark.ckan_config('ckanext.qgov.metrics.token', 'scrape-token')
+    def test_metrics_with_token(self, app):
+        response = app.get('/ckan-admin/qgov-metrics',
+                           headers={'Authorization': 'Bearer scrape-token'})
+        assert '# TYPE ckanext_qgov_login_attempts_total counter' in response.body
+
+    def test_locked_accounts_are_listed_and_unlocked(self, app):
+        user = _locked_user()
+        assert user.name in dict(ratelimit.blocked('login', 'account'))
+
+        sysadmin = factories.Sysadmin()
+        headers = {'Authorization': factories.APIToken(user=sysadmin['name'])['token']}
+        response = app.get('/ckan-admin/locked-accounts', headers=headers)
+        assert user.name in response.body
+
+        app.post('/ckan-admin/locked-accounts', data={'account': [user.name]}, headers=headers)
+        assert user.name not in dict(ratelimit.blocked('login', 'account'))
+        assert qgov_authenticate({"login": user.name, "password": "somepass"})
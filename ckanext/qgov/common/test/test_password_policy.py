@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+import hashlib
+
+import pytest
+
+from ckanext.qgov.common import breached_passwords, password_policy
+from ckanext.qgov.common.password_policy import PasswordPolicy
+
+
+def _messages(policy, password):
+    return [message for message, _params in policy.validate(password)]
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    (r'.*[0-9].*', r'[0-9]'),
+    (r'.*.*[a-z]', r'[a-z]'),
+    (r'^[A-Z]', r'^[A-Z]'),
+    (r'foo\.*', r'foo\.*'),
+    (r'foo\\.*', r'foo\\'),
+])
+def test_strip_wildcards(pattern, expected):
+    assert password_policy.strip_wildcards(pattern) == expected
+
+
+class TestPasswordPolicy(object):
+
+    def test_default_patterns(self):
+        policy = PasswordPolicy.from_config({})
+        assert policy.validate('Abcdefghij1!') == []
+        assert _messages(policy, 'Abc1!') == [password_policy.TOO_SHORT]
+
+    def test_pattern_failures_are_reported_once(self):
+        policy = PasswordPolicy.from_config({})
+        assert _messages(policy, 'alllowercaseletters') == [password_policy.MISSING_PATTERN]
+
+    def test_max_length(self):
+        policy = PasswordPolicy(min_length=4, max_length=8)
+        assert _messages(policy, 'abcdefghij') == [password_policy.TOO_LONG]
+        assert policy.validate('abcdefgh') == []
+
+    def test_character_classes(self):
+        policy = PasswordPolicy(min_length=4, min_character_classes=3)
+        assert _messages(policy, 'abcdEFGH') == [password_policy.TOO_FEW_CLASSES]
+        assert policy.validate('abcdEFG1') == []
+
+    def test_entropy(self):
+        policy = PasswordPolicy(min_length=4, min_entropy=60)
+        assert _messages(policy, 'aaaaaaaaaa') == [password_policy.TOO_PREDICTABLE]
+        assert policy.validate('correct horse battery staple') == []
+
+
+class TestBreachedPasswords(object):
+
+    @pytest.fixture
+    def breached_file(self, tmp_path):
+        passwords = ['Password123!', 'Letmein2024!', 'Qwerty12345!']
+        hashes = sorted(hashlib.sha1(password.encode('utf-8')).hexdigest().upper()
+                        for password in passwords)
+        path = str(tmp_path / 'breached.bin')
+        lines = ['{}:42\n'.format(value).encode('ascii') for value in hashes]
+        assert breached_passwords.build(lines, path) == 3
+        return path
+
+    def test_lookup(self, breached_file):
+        hash_file = breached_passwords.BreachedPasswords(breached_file)
+        assert len(hash_file) == 3
+        assert hash_file.is_breached('Letmein2024!')
+        assert not hash_file.is_breached('Letmein2025!')
+
+    def test_replaced_file(self, breached_file):
+        hash_file = breached_passwords.BreachedPasswords(breached_file)
+        assert hash_file.is_breached('Letmein2024!')
+        old_map = hash_file._open()[0]
+
+        lines = ['{}\n'.format(hashlib.sha1(b'Letmein2025!').hexdigest()).encode('ascii')]
+        breached_passwords.build(lines, breached_file)
+        assert hash_file.is_breached('Letmein2025!')
+        assert not hash_file.is_breached('Letmein2024!')
+        # searches already using the old mapping can still finish
+        assert len(old_map[:breached_passwords.HEADER_SIZE]) == breached_passwords.HEADER_SIZE
+
+    def test_unsorted_plaintext_dump(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(breached_passwords, 'SORT_CHUNK_SIZE', 10)
+        passwords = ['password{}'.format(index) for index in range(100)]
+        path = str(tmp_path / 'breached.bin')
+        lines = [(password + '\n').encode('utf-8') for password in passwords + passwords[:5]]
+        assert breached_passwords.build(lines, path, plaintext=True) == 100
+        hash_file = breached_passwords.BreachedPasswords(path)
+        assert all(hash_file.is_breached(password) for password in passwords)
+        assert not hash_file.is_breached('password100')
+
+    def test_missing_file_is_ignored(self, tmp_path):
+        hash_file = breached_passwords.BreachedPasswords(str(tmp_path / 'missing.bin'))
+        assert not hash_file.is_breached('Password123!')
+
+    def test_policy_rejects_breached_password(self, breached_file):
+        policy = PasswordPolicy.from_config({'password_breached_hashes_file': breached_file})
+        assert _messages(policy, 'Password123!') == [password_policy.BREACHED]
+        assert policy.validate('Password1234!') == []
@@ -0,0 +1,102 @@
+# encoding: utf-8
+
+import uuid
+
+import pytest
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import config
+from flask import Flask
+
+from ckanext.qgov.common import ratelimit
+
+
+@pytest.fixture
+def limits():
+    """ Apply a small set of limits for the test, then restore the configured ones.
+    """
+    ratelimit.configure({
+        'ckanext.qgov.ratelimit.login.account': '3/60',
+        'ckanext.qgov.ratelimit.login.ip': '0',
+        'ckanext.qgov.ratelimit.password_reset.ip': '2/60',
+        'ckanext.qgov.ratelimit.trusted_proxies': '1',
+    })
+    yield
+    ratelimit.configure(config)
+
+
+def _identity():
+    return uuid.uuid4().hex
+
+
+@pytest.mark.usefixtures("limits")
+class TestRateLimit(object):
+
+    def test_hits_are_limited_within_window(self):
+        ip = _identity()
+        assert ratelimit.hit('password_reset', ip=ip) == 0
+        assert ratelimit.hit('password_reset', ip=ip) == 0
+        retry_after = ratelimit.hit('password_reset', ip=ip)
+        assert 0 < retry_after <= 60
+        # other clients are unaffected
+        assert ratelimit.hit('password_reset', ip=_identity()) == 0
+
+    def test_check_does_not_count_as_attempt(self):
+        account = _identity()
+        for _ in range(5):
+            assert ratelimit.check('login', account=account) == 0
+        for _ in range(3):
+            ratelimit.hit('login', account=account)
+        assert ratelimit.check('login', account=account) > 0
+
+    def test_repeated_attempts_back_off_exponentially(self):
+        account = _identity()
+        for _ in range(3):
+            ratelimit.hit('login', account=account)
+        backoff_key = ratelimit.rate_limit_key('login', 'account', account) + '.backoff'
+        ratelimit.hit('login', account=account)
+        first_delay = connect_to_redis().pttl(backoff_key)
+        ratelimit.hit('login', account=account)
+        assert connect_to_redis().pttl(backoff_key) > first_delay
+
+    def test_reset_clears_attempts(self):
+        account = _identity()
+        for _ in range(4):
+            ratelimit.hit('login', account=account)
+        assert ratelimit.check('login', account=account) > 0
+        ratelimit.reset('login', account=account)
+        assert ratelimit.check('login', account=account) == 0
+
+    def test_disabled_rule_never_limits(self):
+        ip = _identity()
+        for _ in range(5):
+            assert ratelimit.hit('login', ip=ip) == 0
+
+    def test_legacy_lockout_counter_is_converted(self):
+        account = _identity()
+        key = ratelimit.rate_limit_key('login', 'account', account)
+        assert key.endswith('.ckanext.qgov.login_attempts.' + account)
+        connect_to_redis().set(key, 10, ex=60)
+        assert ratelimit.check('login', account=account) > 0
+        assert connect_to_redis().type(key) in (b'zset', 'zset')
+
+    def test_script_is_reloaded(self):
+        account = _identity()
+        connect_to_redis().script_flush()
+        for _ in range(3):
+            assert ratelimit.hit('login', account=account) == 0
+        assert ratelimit.check('login', account=account) > 0
+
+    def test_client_ip_behind_trusted_proxy(self):
+        app = Flask(__name__)
+        headers = {'X-Forwarded-For': '203.0.113.9, 198.51.100.1'}
+        with app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            assert ratelimit.client_ip() == '198.51.100.1'
+        with app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            assert ratelimit.client_ip() == '10.0.0.1'
+
+    def test_ip_limits_are_opt_in(self):
+        ratelimit.configure({})
+        ip = _identity()
+        for _ in range(60):
+            assert ratelimit.hit('login', ip=ip) == 0
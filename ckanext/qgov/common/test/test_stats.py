@@ -4,11 +4,18 @@
 '''
 
 from datetime import datetime
+import threading
+import time
+
+import mock
 import pytest
 
-from ckan.tests import factories
+from ckan.lib.redis import connect_to_redis
+from ckan.tests import factories, helpers
 from ckan.plugins.toolkit import check_ckan_version
 
+from ckanext.qgov.common import counters, stats, tables
+from ckanext.qgov.common.caching import cache_key
 from ckanext.qgov.common.stats import Stats
 
 
@@ -38,6 +45,13 @@ def resource(dataset):
     return factories.Resource(package_id=dataset['id'])
 
 
+@pytest.fixture()
+def clean_snapshots():
+    stats.clear_snapshots()
+    yield
+    stats.clear_snapshots()
+
+
 @pytest.mark.usefixtures("with_plugins", "clean_db")
 class TestStats():
     """ Test our URL validation.
@@ -59,6 +73,37 @@ class TestStats():
         assert top_orgs[0][0].id == org['id']
         assert top_orgs[0][1] == 1
 
+    @pytest.mark.parametrize('method', ['top_categories', 'top_organisations'])
+    def test_top_queries_do_not_scale_with_limit(self, org, group, statements, method):
+        """ Test that retrieving top groups/organisations takes a constant
+        number of queries, regardless of how many are returned.
+        """
+        for _ in range(3):
+            other_org = factories.Organization()
+            other_group = factories.Group()
+            factories.Dataset(owner_org=other_org['id'], groups=[{"id": other_group['id']}], private=False)
+        # warm up any table metadata
+        getattr(Stats, method)(limit=1)
+
+        del statements[:]
+        assert len(getattr(Stats, method)(limit=1)) == 1
+        single_queries = len(statements)
+
+        del statements[:]
+        assert len(getattr(Stats, method)(limit=10)) == 3
+        assert len(statements) == single_queries == 1
+
+    def test_table_registry(self, statements):
+        """ Test that table metadata is reused rather than reflected
+        on each call.
+        """
+        tables.configure_tables()
+        del statements[:]
+        for name in tables.STATS_TABLES:
+            assert tables.table(name) is tables.table(name)
+            assert tables.table(name).name == name
+        assert statements == []
+
     def test_resource_count(self, resource):
         """ Test that all resources can be counted.
         """
@@ -77,7 +122,189 @@ class TestStats():
             resource['format'], resource.get('webstore_url'), resource['resource_type']
         )
 
+    def test_iter_resource_report(self, dataset, resource):
+        """ Test that the resource report can be streamed in batches.
+        """
+        factories.Resource(package_id=dataset['id'])
+        report = list(Stats.iter_resource_report(chunk_size=1))
+        assert len(report) == 2
+        full_report = Stats.resource_report()
+        assert all(row in full_report for row in report)
+
+    def test_resource_report_export_requires_sysadmin(self, app, resource):
+        """ Test that only sysadmins can download the resource report.
+        """
+        app.get('/ckan-admin/resource_report.csv', status=403)
+
+    @pytest.mark.parametrize('extension', ['csv', 'jsonl'])
+    def test_resource_report_export(self, app, dataset, resource, extension):
+        """ Test that sysadmins can download the resource report.
+        """
+        sysadmin = factories.Sysadmin()
+        token = factories.APIToken(user=sysadmin['name'])['token']
+        response = app.get('/ckan-admin/resource_report.' + extension,
+                           headers={'Authorization': token})
+        assert resource['url'] in response.body
+        assert dataset['title'] in response.body
+
     def test_resource_org_count(self, org, resource):
         """ Test that the resources in an organisation can be counted.
         """
         assert Stats().resource_org_count(org['id']) == 1
+
+    def test_resource_org_counts(self, org, resource, statements):
+        """ Test that resources in all organisations can be counted at once.
+        """
+        other_org = factories.Organization()
+        empty_org = factories.Organization()
+        other_dataset = factories.Dataset(owner_org=other_org['id'], private=False)
+        factories.Resource(package_id=other_dataset['id'])
+        factories.Resource(package_id=other_dataset['id'])
+
+        del statements[:]
+        assert Stats.resource_org_counts() == {org['id']: 1, other_org['id']: 2}
+        assert Stats.resource_org_counts([org['id'], empty_org['id']]) == {org['id']: 1, empty_org['id']: 0}
+        assert len(statements) == 2
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_snapshots")
+class TestStatsSnapshots():
+    """ Test the cached statistics used by templates.
+    """
+
+    @pytest.mark.ckan_config('ckanext.qgov.stats.cache_ttl', '600')
+    def test_top_orgs_snapshot(self, org, resource):
+        """ Test that organisation rankings are served from the snapshot
+        until it expires.
+        """
+        top_orgs = stats.cached_top_organisations()
+        assert len(top_orgs) == 1
+        assert top_orgs[0][0].id == org['id']
+
+        other_org = factories.Organization()
+        factories.Dataset(owner_org=other_org['id'], private=False)
+        assert len(stats.cached_top_organisations()) == 1
+
+        stats.clear_snapshots()
+        assert len(stats.cached_top_organisations()) == 2
+
+    def test_resource_org_count_per_request(self, app, org, resource, statements):
+        """ Test that organisation resource counts are only queried
+        once per request.
+        """
+        other_org = factories.Organization()
+        with app.flask_app.test_request_context():
+            del statements[:]
+            assert stats.cached_resource_org_count(org['id']) == 1
+            assert stats.cached_resource_org_count(other_org['id']) == 0
+            assert len(statements) == 1
+
+    @pytest.mark.ckan_config('ckanext.qgov.stats.resource_org_counts_ttl', '600')
+    def test_resource_org_count_across_requests(self, org, dataset, resource):
+        """ Test that organisation resource counts can be shared
+        between requests.
+        """
+        assert stats.cached_resource_org_count(org['id']) == 1
+        factories.Resource(package_id=dataset['id'])
+        assert stats.cached_resource_org_count(org['id']) == 1
+
+        stats.clear_snapshots()
+        assert stats.cached_resource_org_count(org['id']) == 2
+
+    @pytest.mark.ckan_config('ckanext.qgov.stats.resource_org_counts_ttl', '600')
+    def test_resource_org_counts_expire_locally(self, org, resource):
+        """ Test that reading the shared counts does not extend
+        the lifetime of this worker's copy.
+        """
+        stats.cached_resource_org_counts()
+        expires = stats._RESOURCE_ORG_COUNTS._entries['all'][1]
+        with mock.patch('time.time', return_value=time.time() + 300):
+            stats.cached_resource_org_counts()
+        assert stats._RESOURCE_ORG_COUNTS._entries['all'][1] == expires
+
+    @pytest.mark.ckan_config('ckanext.qgov.stats.cache_ttl', '600')
+    def test_failed_refresh_releases_lock(self):
+        """ Test that another refresh can be attempted straight away
+        after one fails.
+        """
+        with mock.patch.object(stats, '_refresh_snapshot', side_effect=ValueError('failed')):
+            stats._schedule_refresh('top_organisations', 10)
+            for thread in threading.enumerate():
+                if thread.name == 'qgov-stats-top_organisations':
+                    thread.join()
+        assert not connect_to_redis().exists(cache_key('stats', 'top_organisations', 10, 'lock'))
+
+    @pytest.mark.ckan_config('ckanext.qgov.stats.cache_ttl', '0')
+    def test_top_groups_uncached(self, org, group, resource):
+        """ Test that snapshots can be disabled.
+        """
+        assert len(stats.cached_top_categories()) == 1
+
+        other_group = factories.Group()
+        factories.Dataset(owner_org=org['id'], groups=[{"id": other_group['id']}], private=False)
+        assert len(stats.cached_top_categories()) == 2
+
+
+@pytest.fixture()
+def clean_counters():
+    counters.clear()
+    yield
+    counters.clear()
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_snapshots", "clean_counters")
+@pytest.mark.ckan_config('ckanext.qgov.stats.incremental_counters', 'true')
+class TestIncrementalCounters():
+    """ Test the resource counters maintained by plugin hooks.
+    """
+
+    def test_counters_follow_changes(self, org, dataset, resource):
+        """ Test that counters are adjusted as resources and datasets change.
+        """
+        assert counters.reconcile() == (1, {org['id']: 1})
+
+        factories.Resource(package_id=dataset['id'])
+        assert counters.resource_count() == 2
+        assert counters.resource_org_counts() == {org['id']: 2}
+
+        helpers.call_action('package_patch', id=dataset['id'], private=True)
+        assert counters.resource_count() == 0
+        assert counters.resource_org_counts() == {}
+
+        helpers.call_action('package_patch', id=dataset['id'], private=False)
+        assert counters.resource_count() == 2
+
+        helpers.call_action('resource_delete', id=resource['id'])
+        assert counters.resource_count() == 1
+
+        helpers.call_action('package_delete', id=dataset['id'])
+        assert counters.resource_count() == 0
+        assert counters.reconcile() == (0, {})
+
+    def test_helpers_use_counters(self, org, resource):
+        """ Test that the template helpers initialise and use the counters.
+        """
+        assert stats.cached_resource_count() == 1
+        assert stats.cached_resource_org_count(org['id']) == 1
+        assert counters.resource_count() == 1
+
+    def test_delete_by_name(self, org, dataset, resource):
+        """ Test that deleting a dataset by name removes its resources.
+        """
+        assert counters.reconcile() == (1, {org['id']: 1})
+        helpers.call_action('package_delete', id=dataset['name'])
+        assert counters.resource_count() == 0
+        assert counters.resource_org_counts() == {}
+
+    def test_reconcile_once(self, org, resource):
+        """ Test that workers don't rebuild the counters concurrently.
+        """
+        lock = connect_to_redis().lock(cache_key('counters', 'lock'), timeout=60)
+        assert lock.acquire(blocking=False)
+        try:
+            assert counters.reconcile_once() == (None, None)
+            assert stats.cached_resource_count() == 1
+            assert counters.resource_count() is None
+        finally:
+            lock.release()
+        assert counters.reconcile_once() == (1, {org['id']: 1})
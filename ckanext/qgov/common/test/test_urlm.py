@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+'''Tests for the URL Management System integration.
+'''
+
+import json
+import time
+import uuid
+
+import mock
+import pytest
+import requests
+
+from ckanext.qgov.common import urlm
+
+URLM_PATH = 'https://urlm.example.com/services/url?source={source}'
+
+
+def _response(status, location=None):
+    response = mock.Mock()
+    response.json.return_value = {'Status': status, 'Headers': {'location': location}}
+    return response
+
+
+@pytest.fixture()
+def reset_urlm():
+    """ Discard any URL Management settings, breaker state and cached
+    responses left by a test.
+    """
+    yield
+    urlm.configure_urlm(None, None)
+    urlm.clear_cache()
+
+
+@pytest.fixture()
+def missing_url(reset_urlm):
+    urlm.configure_urlm(URLM_PATH, None, {'urlm.failure_threshold': '2', 'urlm.reset_timeout': '60'})
+    yield 'http://ckan:5000/{}'.format(uuid.uuid4())
+
+
+class TestUrlManagement(object):
+    """ Test lookups of redirects for missing pages.
+    """
+
+    def test_redirect_is_cached(self, missing_url):
+        """ Test that a redirect is only looked up once.
+        """
+        with mock.patch.object(urlm.get_session(), 'get', return_value=_response(301, '/new')) as get:
+            assert urlm.get_purl_response(missing_url) == '/new'
+            assert urlm.get_purl_response(missing_url) == '/new'
+        assert get.call_count == 1
+        assert get.call_args[1]['timeout'] == (2, 5)
+
+    def test_miss_is_cached(self, missing_url):
+        """ Test that an unknown URL is not looked up repeatedly.
+        """
+        with mock.patch.object(urlm.get_session(), 'get', return_value=_response(404)) as get:
+            assert urlm.get_purl_response(missing_url) is None
+            assert urlm.get_purl_response(missing_url) is None
+        assert get.call_count == 1
+
+    def test_circuit_breaker(self, missing_url):
+        """ Test that lookups are suspended after repeated failures.
+        """
+        with mock.patch.object(urlm.get_session(), 'get', side_effect=requests.exceptions.Timeout) as get:
+            for suffix in range(4):
+                assert urlm.get_purl_response(missing_url + str(suffix)) is None
+        assert get.call_count == 2
+
+    def test_session_is_reused(self, missing_url):
+        """ Test that lookups share a pooled session with the proxy applied.
+        """
+        urlm.configure_urlm(URLM_PATH, 'proxy:3128', {'urlm.pool_size': '4'})
+        session = urlm.get_session()
+        assert urlm.get_session() is session
+        assert session.proxies['https'] == 'https://proxy:3128'
+        assert session.get_adapter('https://urlm.example.com')._pool_maxsize == 4
+
+    def test_deadline(self, missing_url):
+        """ Test that a slow lookup doesn't hold up the response,
+        and its answer is used for the next request.
+        """
+        urlm.configure_urlm(URLM_PATH, None, {'urlm.async_deadline': '0.1'})
+
+        def slow_response(*args, **kwargs):
+            time.sleep(0.5)
+            return _response(301, '/new')
+
+        with mock.patch.object(urlm.get_session(), 'get', side_effect=slow_response) as get:
+            assert urlm.resolve_purl(missing_url) is None
+            assert urlm.resolve_purl(missing_url) is None
+            time.sleep(0.6)
+            assert urlm.resolve_purl(missing_url) == '/new'
+        assert get.call_count == 1
+
+
+@pytest.mark.usefixtures("reset_urlm")
+class TestRedirectMap(object):
+    """ Test the local redirect map.
+    """
+
+    def test_normalise_url(self):
+        assert urlm.normalise_url('HTTPS://Data.QLD.gov.au:443/dataset/foo/') == 'https://data.qld.gov.au/dataset/foo'
+        assert urlm.normalise_url('http://ckan:5000') == 'http://ckan:5000/'
+
+    def test_local_redirects(self, tmp_path):
+        """ Test that redirects are served from the map without
+        contacting URL Management.
+        """
+        export = tmp_path / 'redirects.json'
+        export.write_text(json.dumps([{'source': 'http://ckan:5000/old/', 'target': 'http://ckan:5000/new'}]))
+        redirect_map = str(tmp_path / 'redirects.sqlite')
+        assert urlm.build_redirect_map(urlm.read_redirects(str(export)), redirect_map) == 1
+
+        urlm.configure_urlm(URLM_PATH, None, {'urlm.redirect_map': redirect_map, 'urlm.redirect_map_only': 'true'})
+        with mock.patch.object(urlm.get_session(), 'get') as get:
+            assert urlm.get_purl_response('http://CKAN:5000/old') == 'http://ckan:5000/new'
+            assert urlm.get_purl_response('http://ckan:5000/{}'.format(uuid.uuid4())) is None
+        assert get.call_count == 0
+
+        csv_export = tmp_path / 'redirects.csv'
+        csv_export.write_text('source,target\nhttp://ckan:5000/other,http://ckan:5000/new\n')
+        urlm.build_redirect_map(urlm.read_redirects(str(csv_export)), redirect_map)
+        assert urlm.get_purl_response('http://ckan:5000/other') == 'http://ckan:5000/new'
+        assert urlm.get_purl_response('http://ckan:5000/old') is None
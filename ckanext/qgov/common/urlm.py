@@ -2,43 +2,397 @@
 """ Functions for URL Management System interaction.
 """
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import csv
+import hashlib
+import io
+import json
 from logging import getLogger
+import os
+import sqlite3
+from threading import local, Lock
+import time
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import pathname2url
+
+from redis.exceptions import RedisError
 import requests
 
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import asbool
+
+from .caching import cache_key, LRUCache, redis_get, redis_set
+from .http_session import ProcessSession
+
 LOG = getLogger(__name__)
 
 URLM_ENDPOINT = None
 URLM_PROXY = None
+URLM_TIMEOUT = (2, 5)
+POOL_SIZE = 10
+RETRIES = 1
+
+_SESSION = ProcessSession()
+
+CACHE_TTL = 3600
+NEGATIVE_CACHE_TTL = 300
+_CACHE = LRUCache(max_size=1000)
+
+
+class CircuitBreaker(object):
+    """ Stop contacting a service after repeated failures,
+    then allow a single trial request after 'reset_timeout' seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.opened_at + self.reset_timeout <= time.time():
+                # let one request through; it will re-open on failure
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    LOG.warning("URL Management System failed %s times; suspending lookups for %ss",
+                                self.failures, self.reset_timeout)
+                self.opened_at = time.time()
+
+
+_BREAKER = CircuitBreaker()
+
+REDIRECT_MAP = None
+REDIRECT_MAP_ONLY = False
+
+ASYNC_DEADLINE = 0
+ASYNC_WORKERS = 4
+ASYNC_MAX_PENDING = 100
+_EXECUTOR = None
+_EXECUTOR_PID = None
+_PENDING = {}
+_PENDING_LOCK = Lock()
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalise_url(url):
+    """ Reduce a URL to a canonical form for redirect lookups:
+    lower-case scheme and host, no default port, fragment
+    or trailing slash.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = '{}:{}'.format(host, parts.port)
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((scheme, host, path, parts.query, ''))
+
+
+class RedirectMap(object):
+    """ Read-only lookups in a local SQLite table of redirects,
+    as built by 'ckan qgov sync-redirects'.
+
+    Each thread keeps its own connection, and reopens it if the file
+    has been replaced by a newer sync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _connection(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.signature != signature:
+            if connection is not None:
+                connection.close()
+            connection = sqlite3.connect(
+                'file:{}?mode=ro'.format(pathname2url(self.path)), uri=True)
+            self._local.connection = connection
+            self._local.signature = signature
+        return connection
+
+    def lookup(self, url):
+        """ Find the redirect target for a URL, if any.
+        """
+        try:
+            connection = self._connection()
+            if connection is None:
+                return None
+            row = connection.execute(
+                'SELECT target FROM redirects WHERE source = ?',
+                (normalise_url(url),)).fetchone()
+        except sqlite3.Error as e:
+            LOG.error("Failed to read redirect map %s: %s", self.path, e)
+            return None
+        return row[0] if row else None
+
+
+def build_redirect_map(redirects, path):
+    """ Write (source, target) pairs to a new redirect map,
+    then atomically replace the file at 'path'.
+    Returns the number of redirects stored.
+    """
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('CREATE TABLE redirects (source TEXT PRIMARY KEY, target TEXT NOT NULL) WITHOUT ROWID')
+        connection.executemany(
+            'INSERT OR REPLACE INTO redirects (source, target) VALUES (?, ?)',
+            ((normalise_url(source), target) for source, target in redirects if source and target))
+        connection.commit()
+        count = connection.execute('SELECT COUNT(*) FROM redirects').fetchone()[0]
+    finally:
+        connection.close()
+    os.replace(temp_path, path)
+    return count
+
+
+def read_redirects(source):
+    """ Load (source, target) pairs from a URL Management export URL,
+    or a local JSON or CSV file.
+
+    JSON may be either an object mapping sources to targets, or a list
+    of objects with 'source' and 'target' keys. CSV has source and
+    target columns, with an optional header row.
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        response = get_session().get(source, timeout=(URLM_TIMEOUT[0], 300))
+        response.raise_for_status()
+        text = response.text
+        is_csv = 'csv' in response.headers.get('content-type', '')
+    else:
+        with io.open(source, encoding='utf-8') as source_file:
+            text = source_file.read()
+        is_csv = source.lower().endswith('.csv')
+
+    if is_csv:
+        for row in csv.reader(io.StringIO(text)):
+            if len(row) >= 2 and row[0].strip().lower() != 'source':
+                yield row[0].strip(), row[1].strip()
+        return
+
+    data = json.loads(text)
+    if isinstance(data, dict):
+        for redirect_source, target in data.items():
+            yield redirect_source, target
+    else:
+        for redirect in data:
+            yield redirect.get('source'), redirect.get('target')
 
 
-def configure_urlm(app_path, proxy):
+def configure_urlm(app_path, proxy, settings=None):
     """
     app_path: The path to the URL Management system
     proxy: The proxy, if any, to be used in contacting the URL Management system.
+    settings: The CKAN config, for optional timeout, circuit breaker
+    and cache settings.
     """
-    global URLM_ENDPOINT, URLM_PROXY
+    global URLM_ENDPOINT, URLM_PROXY, URLM_TIMEOUT, POOL_SIZE, RETRIES, \
+        CACHE_TTL, NEGATIVE_CACHE_TTL, _CACHE, _BREAKER, _SESSION, \
+        REDIRECT_MAP, REDIRECT_MAP_ONLY, ASYNC_DEADLINE, ASYNC_WORKERS, ASYNC_MAX_PENDING, _EXECUTOR
     URLM_ENDPOINT = app_path
     URLM_PROXY = proxy
 
+    settings = settings or {}
+    URLM_TIMEOUT = (float(settings.get('urlm.connect_timeout', 2)),
+                    float(settings.get('urlm.read_timeout', 5)))
+    POOL_SIZE = int(settings.get('urlm.pool_size', 10))
+    RETRIES = int(settings.get('urlm.retries', 1))
+    CACHE_TTL = int(settings.get('urlm.cache_ttl', 3600))
+    NEGATIVE_CACHE_TTL = int(settings.get('urlm.negative_cache_ttl', 300))
+    _CACHE = LRUCache(max_size=int(settings.get('urlm.cache_size', 1000)))
+    _BREAKER = CircuitBreaker(int(settings.get('urlm.failure_threshold', 5)),
+                              int(settings.get('urlm.reset_timeout', 60)))
+    redirect_map_path = settings.get('urlm.redirect_map')
+    REDIRECT_MAP = RedirectMap(redirect_map_path) if redirect_map_path else None
+    REDIRECT_MAP_ONLY = asbool(settings.get('urlm.redirect_map_only', False))
+    ASYNC_DEADLINE = float(settings.get('urlm.async_deadline', 0))
+    ASYNC_WORKERS = int(settings.get('urlm.async_workers', 4))
+    ASYNC_MAX_PENDING = int(settings.get('urlm.async_max_pending', 100))
+    with _PENDING_LOCK:
+        if _EXECUTOR is not None:
+            _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+
+    _SESSION = ProcessSession(pool_size=POOL_SIZE, retries=RETRIES, proxy=URLM_PROXY)
+
     LOG.info("Using URL Management system at %s via proxy %s", URLM_ENDPOINT, URLM_PROXY)
 
 
-def get_purl_response(url):
-    global URLM_ENDPOINT, URLM_PROXY
-    LOG.warn("Page [%s] not found; checking URL Management System at %s",
-             url, URLM_ENDPOINT)
+def get_session():
+    """ Retrieve the HTTP session for this process.
+    """
+    return _SESSION.get()
+
+
+def _redis_key(url):
+    return cache_key('urlm', hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def get_cached_response(url):
+    """ Look up a previous URL Management response.
+    Returns the redirect target, '' for a known miss, or None if unknown.
+    """
+    location = _CACHE.get(url)
+    if location is None:
+        location = redis_get(_redis_key(url))
+        if location is not None:
+            _CACHE.set(url, location, ttl=CACHE_TTL if location else NEGATIVE_CACHE_TTL)
+    return location
+
+
+def cache_response(url, location):
+    """ Record a redirect target, or '' for a miss, locally and in Redis.
+    """
+    ttl = CACHE_TTL if location else NEGATIVE_CACHE_TTL
+    _CACHE.set(url, location, ttl=ttl)
+    redis_set(_redis_key(url), location, ttl=ttl)
+
+
+def clear_cache():
+    """ Discard all cached URL Management responses, locally and in Redis.
+    """
+    _CACHE.clear()
+    try:
+        redis_conn = connect_to_redis()
+        keys = list(redis_conn.scan_iter(match=cache_key('urlm', '*')))
+        if keys:
+            redis_conn.delete(*keys)
+    except RedisError as e:
+        LOG.warning("Unable to clear cached URL Management responses: %s", e)
+
+
+def _known_response(url):
+    """ Check for an answer that doesn't require contacting
+    URL Management: the local redirect map, cached responses,
+    or lookups being suspended.
+    Returns a (known, location) tuple.
+    """
+    if REDIRECT_MAP:
+        location = REDIRECT_MAP.lookup(url)
+        if location:
+            LOG.info("Page [%s] not found; redirecting to %s from local redirect map", url, location)
+            return True, location
+        if REDIRECT_MAP_ONLY:
+            return True, None
+    if not URLM_ENDPOINT:
+        return True, None
+    location = get_cached_response(url)
+    if location is not None:
+        LOG.debug("Using cached URL Management response for %s", url)
+        return True, location or None
+    if not _BREAKER.allow():
+        LOG.warning("Page [%s] not found; URL Management System is suspended after failures", url)
+        return True, None
+    return False, None
+
+
+def _query_urlm(url):
+    """ Ask URL Management for a redirect, and cache the answer.
+    """
+    LOG.warning("Page [%s] not found; checking URL Management System at %s",
+                url, URLM_ENDPOINT)
     purl_request = URLM_ENDPOINT.format(source=url)
     try:
-        if URLM_PROXY:
-            kwargs = {'proxies': {'http': 'http://' + URLM_PROXY, 'https': 'https://' + URLM_PROXY}}
-        else:
-            kwargs = {}
-        response = requests.get(purl_request, **kwargs).json()
+        response = get_session().get(purl_request, timeout=URLM_TIMEOUT).json()
         if response['Status'] == 301:
             location = response['Headers']['location']
             LOG.info("Found; redirecting to %s", location)
-            return location
         else:
-            LOG.warn("No match in URL Management System")
-    except requests.exceptions.RequestException as ex:
+            location = ''
+            LOG.warning("No match in URL Management System")
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as ex:
         LOG.error("Failed to contact URL Management system: %s", ex)
+        _BREAKER.record_failure()
+        return None
+    _BREAKER.record_success()
+    cache_response(url, location)
+    return location or None
+
+
+def get_purl_response(url):
+    known, location = _known_response(url)
+    if known:
+        return location
+    return _query_urlm(url)
+
+
+def _get_executor():
+    """ Retrieve the background lookup pool for this process.
+    """
+    global _EXECUTOR, _EXECUTOR_PID
+    if _EXECUTOR is None or _EXECUTOR_PID != os.getpid():
+        with _PENDING_LOCK:
+            if _EXECUTOR is None or _EXECUTOR_PID != os.getpid():
+                _EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix='urlm')
+                _EXECUTOR_PID = os.getpid()
+                _PENDING.clear()
+    return _EXECUTOR
+
+
+def _submit_lookup(url):
+    """ Start a background lookup, or join one already in progress
+    for the same URL. Returns None if too many lookups are pending.
+    """
+    executor = _get_executor()
+    with _PENDING_LOCK:
+        future = _PENDING.get(url)
+        if future is None:
+            if len(_PENDING) >= ASYNC_MAX_PENDING:
+                return None
+            future = executor.submit(_query_urlm, url)
+            _PENDING[url] = future
+            future.add_done_callback(lambda done: _PENDING.get(url) is done and _PENDING.pop(url, None))
+    return future
+
+
+def resolve_purl(url):
+    """ Look up a redirect for a missing page without tying up the
+    worker for longer than 'urlm.async_deadline' seconds.
+
+    Lookups run on a shared background pool. If URL Management doesn't
+    answer in time, None is returned so that the normal 404 page can be
+    shown, and the late answer is cached for the next request.
+    If no deadline is configured, the lookup is synchronous.
+    """
+    if not ASYNC_DEADLINE:
+        return get_purl_response(url)
+    known, location = _known_response(url)
+    if known:
+        return location
+    future = _submit_lookup(url)
+    if future is None:
+        LOG.warning("Page [%s] not found; too many URL Management lookups pending", url)
+        return None
+    try:
+        return future.result(timeout=ASYNC_DEADLINE)
+    except FutureTimeoutError:
+        LOG.warning("Page [%s] not found; URL Management did not answer within %ss", url, ASYNC_DEADLINE)
+        return None
@@ -1,6 +1,7 @@
 import ckan.plugins.toolkit as toolkit
 import ckan.logic.schema as schema
 
+from ckanext.qgov.common.authenticator import forget_unknown_user
 from ckanext.qgov.common.user_creation import helpers as user_creation_helpers
 
 
@@ -8,4 +9,6 @@ from ckanext.qgov.common.user_creation import helpers as user_creation_helpers
 def user_create(original_action, context, data_dict):
     modified_schema = context.get('schema') or schema.default_user_schema()
     context['schema'] = user_creation_helpers.add_custom_validator_to_user_schema(modified_schema)
-    return original_action(context, data_dict)
+    user_dict = original_action(context, data_dict)
+    forget_unknown_user(data_dict.get('name'))
+    return user_dict
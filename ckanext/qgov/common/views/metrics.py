@@ -0,0 +1,68 @@
+# encoding: utf-8
+""" Login metrics and account lockout administration.
+"""
+
+import hmac
+
+from flask import Blueprint, Response
+
+from ckan.plugins.toolkit import _, abort, check_access, config, g, h, \
+    redirect_to, render, request, NotAuthorized
+
+from .. import metrics, ratelimit
+
+blueprint = Blueprint(u'qgov_metrics', __name__)
+
+
+def _is_sysadmin():
+    try:
+        check_access(u'sysadmin', {u'user': g.user})
+        return True
+    except NotAuthorized:
+        return False
+
+
+def _has_metrics_token():
+    token = config.get(u'ckanext.qgov.metrics.token')
+    authorization = request.headers.get(u'Authorization', u'')
+    if not token or not authorization.startswith(u'Bearer '):
+        return False
+    return hmac.compare_digest(authorization[len(u'Bearer '):].strip(), token)
+
+
+def prometheus_metrics():
+    """ Expose the login counters for Prometheus to scrape,
+    to sysadmins or to clients presenting the configured bearer token.
+    """
+    if not _has_metrics_token() and not _is_sysadmin():
+        return abort(403, _(u'Not authorised to view metrics'))
+    return Response(metrics.prometheus_text(),
+                    mimetype=u'text/plain; version=0.0.4')
+
+
+def locked_accounts():
+    """ List the accounts that are currently locked out,
+    and unlock the selected ones.
+    """
+    if not _is_sysadmin():
+        return abort(403, _(u'Need to be system administrator to administer'))
+
+    if request.method == u'POST':
+        account_names = request.form.getlist(u'account')
+        for account_name in account_names:
+            ratelimit.reset(u'login', account=account_name)
+        if account_names:
+            h.flash_success(_(u'Unlocked {count} account(s)').format(count=len(account_names)))
+        return redirect_to(u'qgov_metrics.locked_accounts')
+
+    accounts = sorted(ratelimit.blocked(u'login', u'account'))
+    return render(u'admin/locked_accounts.html', extra_vars={u'accounts': accounts})
+
+
+blueprint.add_url_rule(u'/ckan-admin/qgov-metrics', view_func=prometheus_metrics)
+blueprint.add_url_rule(u'/ckan-admin/locked-accounts', view_func=locked_accounts,
+                       methods=[u'GET', u'POST'])
+
+
+def get_blueprints():
+    return [blueprint]
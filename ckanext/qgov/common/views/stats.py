@@ -0,0 +1,101 @@
+# encoding: utf-8
+""" Downloadable statistics reports.
+"""
+
+import csv
+import datetime
+import io
+import json
+
+from flask import Blueprint, Response, stream_with_context
+
+from ckan import model
+from ckan.plugins.toolkit import _, abort, check_access, g, NotAuthorized
+
+from ..stats import RESOURCE_REPORT_COLUMNS, Stats
+
+CHUNK_SIZE = 1000
+
+blueprint = Blueprint(u'qgov_stats', __name__)
+
+
+def _format_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _csv_chunks(rows):
+    """ Render report rows as CSV, one chunk per batch of rows.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(RESOURCE_REPORT_COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_format_value(value) for value in row])
+        if count % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_chunks(rows):
+    """ Render report rows as newline-delimited JSON,
+    one chunk per batch of rows.
+    """
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(
+            RESOURCE_REPORT_COLUMNS, [_format_value(value) for value in row]))))
+        if len(lines) == CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+REPORT_FORMATS = {
+    u'csv': (_csv_chunks, u'text/csv'),
+    u'jsonl': (_jsonl_chunks, u'application/x-ndjson'),
+}
+
+
+def _stream_report(renderer):
+    """ Render the resource report as it is read.
+    The request's database session is removed before the response is
+    streamed, so the report runs in a session of its own, which must be
+    removed afterwards too.
+    """
+    try:
+        for chunk in renderer(Stats.iter_resource_report(chunk_size=CHUNK_SIZE)):
+            yield chunk
+    finally:
+        model.Session.remove()
+
+
+def resource_report(extension):
+    """ Stream the resource report to sysadmins, without loading it
+    into memory. The response has no length, so it is sent with
+    chunked transfer encoding.
+    """
+    try:
+        check_access(u'sysadmin', {u'user': g.user})
+    except NotAuthorized:
+        return abort(403, _(u'Need to be system administrator to administer'))
+    if extension not in REPORT_FORMATS:
+        return abort(404, _(u'Report format must be either "csv" or "jsonl"'))
+
+    renderer, mimetype = REPORT_FORMATS[extension]
+    response = Response(stream_with_context(_stream_report(renderer)), mimetype=mimetype)
+    response.headers.set(
+        u'Content-Disposition', u'attachment',
+        filename=u'resource_report.{}'.format(extension))
+    return response
+
+
+blueprint.add_url_rule(u'/ckan-admin/resource_report.<extension>', view_func=resource_report)
+
+
+def get_blueprints():
+    return [blueprint]
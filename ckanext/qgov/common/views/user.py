@@ -3,9 +3,11 @@
 from flask import Blueprint
 from typing import Any
 
-from ckan.plugins.toolkit import config, g, redirect_to, url_for
+from ckan.plugins.toolkit import _, abort, config, g, redirect_to, request, url_for
 from ckan.views import user as user_view
 
+from .. import ratelimit
+
 blueprint = Blueprint(u'user_overrides', __name__)
 
 
@@ -23,6 +25,20 @@ def user_edit_override():
     return user_view.EditView().dispatch_request()
 
 
+def request_reset_override():
+    """
+    Rate limit password reset requests per client and per account,
+    before CKAN looks up the account or sends any email.
+    Ref.: ckan/views/user.py > class RequestResetView(...)
+    :return:
+    """
+    if request.method == u'POST' and ratelimit.hit(
+            u'password_reset', ip=ratelimit.client_ip(),
+            account=request.form.get(u'user', u'').strip().lower()):
+        return abort(429, _(u'Too many password reset requests. Please try again later.'))
+    return user_view.RequestResetView().dispatch_request()
+
+
 def _gettext_wrapper(*args: Any, **kwargs: Any):
     translation = original_gettext(*args, **kwargs)
     if 'Bad username or password.' in translation:
@@ -31,6 +47,8 @@ def _gettext_wrapper(*args: Any, **kwargs: Any):
 
 
 blueprint.add_url_rule(u'/user/edit', u'edit', user_edit_override)
+blueprint.add_url_rule(u'/user/reset', u'request_reset', request_reset_override,
+                       methods=[u'GET', u'POST'])
 if config.get('ckan.recaptcha.privatekey'):
     original_gettext = user_view._
     user_view._ = _gettext_wrapper